@@ -1,11 +1,11 @@
 import streamlit as st
 import pandas as pd
-import string
-import mailchimp_marketing as MailchimpMarketing
-from mailchimp_marketing.api_client import ApiClientError
-import json
-import gspread
-from google.oauth2.service_account import Credentials
+import hashlib
+import io
+import os
+import time
+from engine import LISTS, SHEET_NAMES, get_worksheet, group_by_list, read_contacts
+from worker import JOB_INBOX_DIR, JobQueue, start_background_worker
 
 # Configuración de la página
 st.set_page_config(
@@ -59,72 +59,18 @@ def check_password():
         return False
     return st.session_state["password_correct"]
 
-def excel_column_names(n):
-    """Generate Excel-style column names (A, B, ..., Z, AA, AB, ...) for n columns."""
-    names = []
-    for i in range(n):
-        name = ''
-        col = i
-        while True:
-            name = chr(65 + (col % 26)) + name
-            col = col // 26 - 1
-            if col < 0:
-                break
-        names.append(name)
-    return names
-
-# Mailchimp config
-MAILCHIMP_API_KEY = st.secrets["mailchimp_api_key"]
-MAILCHIMP_SERVER = st.secrets["mailchimp_server"]
-LISTS = {
-    "Bravo NY": "0a06e5f3d3",
-    "Bravo FL": "eab6821d7c",
-    "CTown": "7a827d6afc"
-}
-
-# Google Sheets config
-GOOGLE_SHEETS_CREDENTIALS = {
-    "type": "service_account",
-    "project_id": "main-guild-437619-m2",
-    "private_key_id": st.secrets["private_key_id"],
-    "private_key": st.secrets["google_credentials"],
-    "client_email": "systems-specialist@main-guild-437619-m2.iam.gserviceaccount.com",
-    "client_id": "101632772111851962527",
-    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-    "token_uri": "https://oauth2.googleapis.com/token",
-    "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-    "client_x509_cert_url": "https://www.googleapis.com/robot/v1/metadata/x509/systems-specialist%40main-guild-437619-m2.iam.gserviceaccount.com",
-    "universe_domain": "googleapis.com"
-}
-
-GOOGLE_SHEET_ID = "15adUqyAx4bO-Gz7RweIxxSHziKn3iVwa5e8Ac-iypf0"
-SHEET_NAMES = {
-    "Bravo NY": "Bravo NY",
-    "Bravo FL": "Bravo FL", 
-    "CTown": "CTOWN"
-}
-
 def test_google_sheets_access():
     """
     Prueba el acceso a Google Sheets para verificar que las credenciales funcionan
     """
     try:
-        scopes = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        creds = Credentials.from_service_account_info(GOOGLE_SHEETS_CREDENTIALS, scopes=scopes)
-        client = gspread.authorize(creds)
-        
-        # Intentar abrir la hoja de cálculo
-        sheet = client.open_by_key(GOOGLE_SHEET_ID)
-        
         # Verificar que las hojas existen
         for list_name, sheet_name in SHEET_NAMES.items():
             try:
-                worksheet = sheet.worksheet(sheet_name)
+                worksheet = get_worksheet(sheet_name)
                 st.success(f"✅ Access verified for sheet: {sheet_name}")
             except Exception as e:
+                get_worksheet.cache_clear()
                 st.error(f"❌ Cannot access sheet '{sheet_name}': {str(e)}")
                 return False
         
@@ -134,218 +80,84 @@ def test_google_sheets_access():
         st.error(f"❌ Google Sheets access test failed: {str(e)}")
         return False
 
-def save_to_google_sheets(list_name, contacts_data, results):
+# Cola de trabajos: la app solo encola los archivos y muestra su progreso;
+# la carga la hace un worker (el de este proceso o un `cli.py worker` aparte)
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
+
+@st.cache_resource
+def ensure_local_worker():
+    """Arranca un worker dentro del proceso de Streamlit, salvo que run_local_worker sea false."""
+    if st.secrets.get("run_local_worker", True):
+        return start_background_worker()
+
+def save_upload(data, file_name, file_hash):
+    """Guarda el archivo subido en JOB_INBOX_DIR, con su hash como nombre, para que lo lea el worker."""
+    os.makedirs(JOB_INBOX_DIR, exist_ok=True)
+    extension = os.path.splitext(file_name)[1].lower()
+    path = os.path.join(JOB_INBOX_DIR, f"{file_hash}{extension}")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(data)
+    return path
+
+# Lectura del archivo subido, memorizada por hash de contenido: los reruns
+# (checkbox, botón) no vuelven a leer el archivo. _data no forma parte de la
+# clave; max_entries y ttl limitan cuántos archivos se conservan.
+PARSE_CACHE_ENTRIES = 4
+PARSE_CACHE_TTL = 3600
+# Filas asignadas que se leen para la vista previa
+PREVIEW_ROWS = 5
+
+def _as_file(data, file_name):
+    """Contenido de un archivo subido como objeto de archivo con nombre, para read_contacts."""
+    buffer = io.BytesIO(data)
+    buffer.name = file_name
+    return buffer
+
+@st.cache_data(max_entries=PARSE_CACHE_ENTRIES, ttl=PARSE_CACHE_TTL, show_spinner=False)
+def preview_contacts(file_hash, file_name, _data):
+    """Primeras filas filtradas y asignadas, leyendo solo el principio del archivo."""
+    df, has_status = read_contacts(_as_file(_data, file_name), chunk_rows=1000, limit=PREVIEW_ROWS)
+    return df.head(PREVIEW_ROWS), has_status
+
+@st.cache_data(max_entries=PARSE_CACHE_ENTRIES, ttl=PARSE_CACHE_TTL, show_spinner=False)
+def count_leads(file_hash, file_name, _data):
     """
-    Guarda los resultados de la carga en Google Sheets
-    contacts_data: lista de diccionarios con la información de los contactos
-    results: diccionario con 'success' y 'failed' counts
+    Lee el archivo completo y devuelve los leads por lista. Solo se guarda el
+    recuento: el DataFrame completo no hace falta en la interfaz, el worker
+    vuelve a leer el archivo al subirlo.
     """
-    try:
-        # Configurar credenciales con scopes correctos
-        scopes = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        creds = Credentials.from_service_account_info(GOOGLE_SHEETS_CREDENTIALS, scopes=scopes)
-        client = gspread.authorize(creds)
-        
-        # Abrir la hoja de cálculo
-        sheet = client.open_by_key(GOOGLE_SHEET_ID)
-        worksheet = sheet.worksheet(SHEET_NAMES[list_name])
-        
-        # Preparar datos para insertar
-        rows_to_insert = []
-        for contact in contacts_data:
-            email = contact.get('email_address', '')
-            first_name = contact.get('merge_fields', {}).get('FNAME', '')
-            phone = contact.get('merge_fields', {}).get('PHONE', '')  # Si existe campo phone
-            check_status = "✅" if contact.get('uploaded', False) else "❌"
-            
-            rows_to_insert.append([email, first_name, phone, check_status])
-        
-        # Insertar datos en la hoja
-        if rows_to_insert:
-            worksheet.append_rows(rows_to_insert)
-            st.success(f"✅ {len(rows_to_insert)} records saved to Google Sheets ({list_name})")
-        else:
-            st.warning(f"No data to save for {list_name}")
-            
-    except Exception as e:
-        st.error(f"❌ Error saving to Google Sheets ({list_name}): {str(e)}")
-        # Mostrar más detalles del error para debugging
-        import traceback
-        st.error(f"Full error details: {traceback.format_exc()}")
-
-def add_contacts_to_mailchimp(df, lists, extra_fields_map=None, chunk_size=1000):
-    import hashlib
-    import time
-    client = MailchimpMarketing.Client()
-    client.set_config({
-        "api_key": MAILCHIMP_API_KEY,
-        "server": MAILCHIMP_SERVER
-    })
-    results = {}
-    
-    for list_name, list_id in lists.items():
-        success, failed = 0, 0
-        st.info(f"Processing list: {list_name} (ID: {list_id}) with {len(df)} contacts...")
-        
-        # Preparar todos los contactos
-        valid_contacts = []
-        invalid_emails = []
-        contacts_data = []  # Para guardar en Google Sheets
-        
-        for idx, row in df.iterrows():
-            email = str(row['B']).strip()
-            member_info = {}
-            
-            if extra_fields_map and list_name in extra_fields_map:
-                email = str(row[extra_fields_map[list_name]['email']]).strip()
-                merge_fields = {}
-                for field, col in extra_fields_map[list_name].items():
-                    if field == 'email':
-                        continue
-                    merge_fields[field] = str(row[col]).strip()
-                member_info = {
-                    "email_address": email,
-                    "status": "subscribed",
-                    "merge_fields": merge_fields
-                }
-            else:
-                member_info = {
-                    "email_address": email,
-                    "status": "subscribed"
-                }
-                
-            if pd.isna(email) or '@' not in email:
-                st.warning(f"Skipping row {idx+1}: invalid email '{email}'")
-                invalid_emails.append(idx)
-                failed += 1
-                # Agregar a contacts_data como fallido
-                contacts_data.append({
-                    'email_address': email,
-                    'merge_fields': member_info.get('merge_fields', {}),
-                    'uploaded': False
-                })
-                continue
-                
-            valid_contacts.append(member_info)
-            # Agregar a contacts_data para tracking
-            contacts_data.append({
-                'email_address': email,
-                'merge_fields': member_info.get('merge_fields', {}),
-                'uploaded': False  # Se actualizará después
-            })
-        
-        if valid_contacts:
-            # Dividir en bloques
-            total_contacts = len(valid_contacts)
-            num_chunks = (total_contacts + chunk_size - 1) // chunk_size  # Redondear hacia arriba
-            
-            st.info(f"Dividing {total_contacts} contacts into {num_chunks} chunks of {chunk_size} contacts each...")
-            
-            chunk_start_idx = 0  # Para rastrear el índice en contacts_data
-            
-            for chunk_idx in range(num_chunks):
-                start_idx = chunk_idx * chunk_size
-                end_idx = min((chunk_idx + 1) * chunk_size, total_contacts)
-                chunk_contacts = valid_contacts[start_idx:end_idx]
-                
-                st.info(f"Processing chunk {chunk_idx + 1}/{num_chunks} ({len(chunk_contacts)} contacts)...")
-                
-                # Preparar operaciones para este bloque
-                operations = []
-                for contact in chunk_contacts:
-                    operations.append({
-                        "method": "POST",
-                        "path": f"/lists/{list_id}/members",
-                        "body": json.dumps(contact)
-                    })
-                
-                # Intentar cargar el bloque con reintentos
-                max_retries = 3
-                retry_count = 0
-                chunk_success = False
-                
-                while retry_count < max_retries and not chunk_success:
-                    try:
-                        response = client.batches.start({"operations": operations})
-                        batch_id = response["id"]
-                        
-                        st.info(f"Batch started with ID: {batch_id}")
-                        
-                        # Monitorear el estado del batch
-                        status = "pending"
-                        attempts = 0
-                        max_attempts = 60  # Aumentar a 2 minutos
-                        
-                        while status in ["pending", "processing", "started"] and attempts < max_attempts:
-                            time.sleep(3)  # Aumentar intervalo a 3 segundos
-                            try:
-                                batch_status = client.batches.status(batch_id)
-                                status = batch_status["status"]
-                                
-                                # Mostrar información detallada del estado
-                                if "total_operations" in batch_status:
-                                    completed = batch_status.get("finished_operations", 0)
-                                    total = batch_status.get("total_operations", 0)
-                                    st.info(f"Chunk {chunk_idx + 1}: Status={status}, Progress={completed}/{total}")
-                                else:
-                                    st.info(f"Chunk {chunk_idx + 1}: Status={status} (attempt {attempts}/{max_attempts})")
-                                    
-                            except ApiClientError as status_error:
-                                st.warning(f"Error checking batch status: {status_error.text}")
-                                break
-                                
-                            attempts += 1
-                            
-                            # Mostrar progreso cada 10 segundos
-                            if attempts % 3 == 0:
-                                st.info(f"Chunk {chunk_idx + 1}: Still processing... (attempt {attempts}/{max_attempts})")
-                        
-                        if status == "finished":
-                            chunk_success = True
-                            success += len(chunk_contacts)
-                            # Marcar como exitoso en contacts_data
-                            for i in range(len(chunk_contacts)):
-                                contacts_data[chunk_start_idx + i]['uploaded'] = True
-                            st.success(f"Chunk {chunk_idx + 1}/{num_chunks} completed successfully. {len(chunk_contacts)} contacts uploaded.")
-                        elif status == "started":
-                            # Si está en "started" por mucho tiempo, considerarlo como fallido
-                            st.error(f"Chunk {chunk_idx + 1} stuck in 'started' status. Moving to next chunk.")
-                            failed += len(chunk_contacts)
-                        else:
-                            st.error(f"Chunk {chunk_idx + 1} failed. Final status: {status}")
-                            failed += len(chunk_contacts)
-                            
-                    except ApiClientError as error:
-                        retry_count += 1
-                        st.warning(f"Chunk {chunk_idx + 1} failed (attempt {retry_count}/{max_retries}): {error.text}")
-                        
-                        if retry_count < max_retries:
-                            st.info(f"Retrying chunk {chunk_idx + 1} in 10 seconds...")
-                            time.sleep(10)  # Aumentar tiempo de espera
-                        else:
-                            st.error(f"Chunk {chunk_idx + 1} failed after {max_retries} attempts. Moving to next chunk.")
-                            failed += len(chunk_contacts)
-                
-                chunk_start_idx += len(chunk_contacts)
-                
-                # Pausa entre bloques para evitar rate limiting
-                if chunk_idx < num_chunks - 1:
-                    st.info("Waiting 5 seconds before next chunk...")
-                    time.sleep(5)  # Aumentar pausa entre bloques
-            
-            st.success(f"Bulk upload completed for {list_name}. Total: {success} successful, {failed} failed.")
-            
-            # Guardar resultados en Google Sheets
-            st.info(f"Saving results to Google Sheets for {list_name}...")
-            save_to_google_sheets(list_name, contacts_data, {"success": success, "failed": failed})
-        else:
-            st.warning(f"No valid contacts found for {list_name}")
-            
-        results[list_name] = {"success": success, "failed": failed}
-    return results
+    df, _ = read_contacts(_as_file(_data, file_name))
+    return {list_name: len(frame) for list_name, frame in group_by_list(df).items()}
+
+def _render_progress(progress_bar, totals, done):
+    """Actualiza la barra de progreso combinada de todas las listas."""
+    total = sum(totals.values())
+    finished = sum(done.values())
+    text = " | ".join(f"{name}: {done[name]}/{totals[name]}" for name in totals)
+    progress_bar.progress(finished / total if total else 1.0, text=text)
+
+def watch_job(job_queue, queue_id, poll_interval=1.0):
+    """Muestra los eventos del trabajo a medida que el worker los guarda, hasta que termina."""
+    progress_bar = None
+    seq = 0
+    while True:
+        # El estado se lee antes que los eventos para no perder los últimos
+        job = job_queue.get(queue_id)
+        for seq, event in job_queue.events(queue_id, seq):
+            if event["type"] == "progress":
+                progress_bar = progress_bar or st.progress(0.0)
+                _render_progress(progress_bar, event["totals"], event["done"])
+            elif event["type"] == "message":
+                getattr(st, event["level"])(event["text"])
+            elif event["type"] == "table":
+                with st.expander(event["title"], expanded=event.get("expanded", False)):
+                    st.dataframe(pd.DataFrame(event["rows"]))
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(poll_interval)
 
 def main():
     if not check_password():
@@ -361,84 +173,62 @@ def main():
 
     st.info(f"Mailchimp List IDs in use: Bravo NY: {LISTS['Bravo NY']}, Bravo FL: {LISTS['Bravo FL']}, CTown: {LISTS['CTown']}")
 
+    job_queue = get_job_queue()
+    ensure_local_worker()
+
     uploaded_file = st.file_uploader("Choose a xlsx or csv file (without headers)", type=['xlsx', 'csv'])
 
-    df = None
-    filtered_df = None
     if uploaded_file is not None:
         try:
-            if uploaded_file.name.endswith('.xlsx'):
-                df = pd.read_excel(uploaded_file, header=None)
-            elif uploaded_file.name.endswith('.csv'):
-                df = pd.read_csv(uploaded_file, header=None, on_bad_lines='skip')
-            # Limpiar celdas con formato ="..."
-            df = df.applymap(lambda x: str(x)[2:-1] if isinstance(x, str) and x.startswith('="') and x.endswith('"') else x)
-            col_names = excel_column_names(df.shape[1])
-            df.columns = col_names
-            # Formatear columna J a 5 dígitos con ceros a la izquierda
-            if 'J' in df.columns:
-                df['J'] = df['J'].apply(lambda x: str(x).zfill(5) if pd.notna(x) and str(x).isdigit() and len(str(x)) < 5 else str(x))
-            if 'L' in df.columns:
-                filtered_df = df[df['L'].astype(str).str.lower() == 'active']
+            data = uploaded_file.getvalue()
+            file_hash = hashlib.sha256(data).hexdigest()
+            # La vista previa solo lee el principio del archivo y se muestra antes de leerlo entero
+            preview_df, has_status = preview_contacts(file_hash, uploaded_file.name, data)
+            if has_status:
                 st.success("File uploaded and filtered successfully. Preview:")
-                st.dataframe(filtered_df.head())
-                if not filtered_df.empty:
-                    # Asignar leads a listas según reglas
-                    bravo_ny = filtered_df[(filtered_df['A'].astype(str).str.upper() == 'BRAVO') & (filtered_df['B'].astype(str).str.startswith(('43', '043')))]
-                    bravo_fl = filtered_df[(filtered_df['A'].astype(str).str.upper() == 'BRAVO') & (filtered_df['B'].astype(str).str.startswith(('45', '045')))]
-                    ctown = filtered_df[(filtered_df['A'].astype(str).str.upper() == 'CTOWN') & (filtered_df['B'].astype(str).str.startswith(('41', '041')))]
-
-                    st.info(f"Bravo NY: {len(bravo_ny)} leads | Bravo FL: {len(bravo_fl)} leads | CTown: {len(ctown)} leads")
-
+                st.dataframe(preview_df)
+                if not preview_df.empty:
+                    with st.spinner("Reading the whole file..."):
+                        # Leads asignados a listas por ROUTING_TABLE
+                        leads = count_leads(file_hash, uploaded_file.name, data)
+
+                    st.info(" | ".join(f"{list_name}: {count} leads" for list_name, count in leads.items()))
+
+                    upsert = st.checkbox(
+                        "Only send new or changed contacts (upsert)",
+                        value=True,
+                        help="Sends PUT requests by subscriber hash and skips contacts already synced with the same data."
+                    )
+                    sync = st.checkbox(
+                        "Sync with the current Mailchimp lists",
+                        value=False,
+                        help="Compares the file with the members already in Mailchimp, sends only new or changed "
+                             "contacts and archives the ones no longer active in column L."
+                    )
                     if st.button("Upload filtered contacts to Mailchimp lists"):
-                        with st.spinner("Uploading contacts to Mailchimp..."):
-                            results = {}
-                            extra_fields_map = {
-                                "Bravo NY": {
-                                    "email": "C",
-                                    "FNAME": "D",
-                                    "LNAME": "E",
-                                    "ADDRESS": "F",
-                                    "ZIPCODE": "J",
-                                    "PHONE": "K"
-                                },
-                                "Bravo FL": {
-                                    "email": "C",
-                                    "FNAME": "D",
-                                    "LNAME": "E",
-                                    "ADDRESS": "F",
-                                    "MMERGE10": "J",  # Full Address Zip
-                                    "MMERGE11": "J",   # Zip
-                                    "PHONE": "K"
-                                },
-                                "CTown": {
-                                    "email": "C",
-                                    "FNAME": "D",
-                                    "LNAME": "E",
-                                    "ADDRESS": "F",
-                                    "ZIPCODE": "J",
-                                    "PHONE": "K"
-                                }
-                            }
-                            if not bravo_ny.empty:
-                                results['Bravo NY'] = add_contacts_to_mailchimp(bravo_ny, {"Bravo NY": LISTS["Bravo NY"]}, extra_fields_map, 700)['Bravo NY']
-                            else:
-                                results['Bravo NY'] = {"success": 0, "failed": 0}
-                            if not bravo_fl.empty:
-                                results['Bravo FL'] = add_contacts_to_mailchimp(bravo_fl, {"Bravo FL": LISTS["Bravo FL"]}, extra_fields_map, 700)['Bravo FL']
-                            else:
-                                results['Bravo FL'] = {"success": 0, "failed": 0}
-                            if not ctown.empty:
-                                results['CTown'] = add_contacts_to_mailchimp(ctown, {"CTown": LISTS["CTown"]}, extra_fields_map, 700)['CTown']
-                            else:
-                                results['CTown'] = {"success": 0, "failed": 0}
-                        for list_name, res in results.items():
-                            st.info(f"List '{list_name}': {res['success']} contacts added, {res['failed']} failed.")
+                        st.session_state["queue_id"] = job_queue.submit(
+                            save_upload(data, uploaded_file.name, file_hash), uploaded_file.name, upsert=upsert, sync=sync
+                        )
             else:
                 st.warning("Column 'L' does not exist in the uploaded file. The file must have at least 12 columns.")
-                st.dataframe(df.head())
+                st.dataframe(preview_df)
         except Exception as e:
             st.error(f"Error reading the file: {e}")
 
+    with st.expander("Recent uploads"):
+        st.dataframe(pd.DataFrame(
+            [{key: value for key, value in job.items() if key != "results"} for job in job_queue.recent()]
+        ))
+
+    # El trabajo sigue en el worker aunque se recargue la página; aquí solo se sigue su progreso
+    if "queue_id" in st.session_state:
+        queue_id = st.session_state["queue_id"]
+        st.subheader(f"Upload {queue_id}")
+        with st.spinner("Uploading contacts to Mailchimp..."):
+            job = watch_job(job_queue, queue_id)
+        if job["status"] == "done":
+            for list_name, res in job["results"].items():
+                st.info(f"List '{list_name}': {res['success']} contacts added, {res['failed']} failed, {res['skipped']} unchanged, {res.get('duplicates', 0)} duplicates, {res.get('other_list', 0)} already sent to another list, {res.get('archived', 0)} archived.")
+
 if __name__ == "__main__":
-    main() 
+    main()
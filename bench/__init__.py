@@ -0,0 +1,13 @@
+"""
+Benchmarks sin conexión del motor de carga: archivos sintéticos (generate.py),
+servidores locales que sustituyen a Mailchimp y Google Sheets (fakes.py) y el
+script que lo mide todo (run.py). Se ejecuta desde la raíz del repositorio:
+
+    python -m bench.run --rows 1000 10000 100000
+"""
+import os
+
+# Contra los servidores falsos no hacen falta credenciales reales, pero engine
+# exige los secrets obligatorios al importarse
+for _key in ("MAILCHIMP_API_KEY", "MAILCHIMP_SERVER", "PRIVATE_KEY_ID", "GOOGLE_CREDENTIALS"):
+    os.environ.setdefault(_key, "offline")
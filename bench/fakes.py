@@ -0,0 +1,249 @@
+"""
+Sustitutos locales de Mailchimp y Google Sheets para los benchmarks.
+
+FakeMailchimpServer es un servidor HTTP que implementa lo que usa el motor de
+la API de batches (POST /3.0/batches, GET /3.0/batches/{id} y el tar.gz de
+resultados) y de los miembros de las listas (GET /3.0/lists/{id}/members,
+con los contactos que han llegado en los batches), con latencia por
+petición, duración de cada batch y tasas de fallo configurables. El cliente de mailchimp_marketing se apunta a él con
+mailchimp_client(), así que se mide también la capa HTTP.
+
+FakeSpreadsheet y FakeWorksheet imitan los métodos de gspread que usa
+SheetsWriter, con latencia y tasa de fallo por petición.
+"""
+import hashlib
+import io
+import json
+import random
+import re
+import tarfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import mailchimp_marketing as MailchimpMarketing
+
+from engine import _pooled_request
+
+class FakeMailchimpServer:
+    """
+    Servidor local de la API de batches de Mailchimp.
+    latency: segundos de espera en cada petición.
+    batch_seconds, seconds_per_operation: un batch termina batch_seconds +
+    seconds_per_operation * operaciones después de enviarse.
+    start_failure_rate: fracción de batches.start que responden 500.
+    operation_error_rate: fracción de operaciones que terminan con 400.
+    """
+
+    def __init__(self, latency=0.0, batch_seconds=1.0, seconds_per_operation=0.0,
+                 start_failure_rate=0.0, operation_error_rate=0.0, seed=0):
+        self.latency = latency
+        self.batch_seconds = batch_seconds
+        self.seconds_per_operation = seconds_per_operation
+        self.start_failure_rate = start_failure_rate
+        self.operation_error_rate = operation_error_rate
+        self.requests = {"start": 0, "status": 0, "results": 0, "members": 0}
+        self.members = {}  # list_id -> {subscriber_hash: (merge_fields, estado)}
+        self._random = random.Random(seed)
+        self._batches = {}  # batch_id -> (enviado, terminado, operation_ids, operaciones con error)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def mailchimp_client(self, session=None):
+        """Cliente de mailchimp_marketing apuntado a este servidor (con las peticiones sobre session)."""
+        client = MailchimpMarketing.Client()
+        client.set_config({"api_key": "bench-us1", "server": "bench"})
+        client.api_client.host = f"{self.url}/3.0"
+        if session is not None:
+            client.api_client.request = _pooled_request(client.api_client, session)
+        return client
+
+    def _start(self, body):
+        operation_ids = [operation["operation_id"] for operation in body["operations"]]
+        with self._lock:
+            self.requests["start"] += 1
+            if self._random.random() < self.start_failure_rate:
+                return 500, {"title": "Internal Server Error", "detail": "Simulated failure"}
+            batch_id = f"bench{len(self._batches):06d}"
+            errored = {operation_id for operation_id in operation_ids if self._random.random() < self.operation_error_rate}
+            submitted = datetime.now(timezone.utc)
+            finished = submitted + timedelta(seconds=self.batch_seconds + self.seconds_per_operation * len(operation_ids))
+            self._batches[batch_id] = (submitted, finished, operation_ids, errored)
+            for operation in body["operations"]:
+                if operation["operation_id"] not in errored:
+                    self._apply(operation)
+        return 200, {"id": batch_id, "status": "pending", "total_operations": len(operation_ids)}
+
+    def _apply(self, operation):
+        """Aplica a self.members una operación de batch (POST, PUT o DELETE de un miembro)."""
+        parts = operation["path"].strip("/").split("/")  # lists/{id}/members[/{hash}]
+        members = self.members.setdefault(parts[1], {})
+        body = json.loads(operation.get("body") or "{}")
+        hash_ = parts[3] if len(parts) > 3 else hashlib.md5(body["email_address"].lower().encode()).hexdigest()
+        merge_fields, status = members.get(hash_, ({}, None))
+        if operation["method"] == "DELETE":
+            if status:
+                members[hash_] = (merge_fields, "archived")
+            return
+        if status in (None, "archived"):
+            status = body.get("status") or body.get("status_if_new")
+        members[hash_] = ({**merge_fields, **body.get("merge_fields", {})}, status)
+
+    def _list_members(self, list_id, query):
+        """Página de miembros de una lista (count y offset de la query)."""
+        with self._lock:
+            self.requests["members"] += 1
+            members = sorted(self.members.get(list_id, {}).items())
+        count, offset = int(query.get("count", ["10"])[0]), int(query.get("offset", ["0"])[0])
+        return 200, {
+            "members": [
+                {"id": hash_, "status": status, "merge_fields": merge_fields}
+                for hash_, (merge_fields, status) in members[offset:offset + count]
+            ],
+            "total_items": len(members)
+        }
+
+    def _status(self, batch_id):
+        with self._lock:
+            self.requests["status"] += 1
+            if batch_id not in self._batches:
+                return 404, {"title": "Resource Not Found", "detail": f"Batch {batch_id} not found"}
+            submitted, finished, operation_ids, errored = self._batches[batch_id]
+        status = {
+            "id": batch_id,
+            "total_operations": len(operation_ids),
+            "submitted_at": submitted.isoformat(),
+        }
+        if datetime.now(timezone.utc) < finished:
+            status.update({"status": "started", "finished_operations": 0, "errored_operations": 0})
+        else:
+            status.update({
+                "status": "finished",
+                "finished_operations": len(operation_ids),
+                "errored_operations": len(errored),
+                "completed_at": finished.isoformat(),
+                "response_body_url": f"{self.url}/results/{batch_id}.tar.gz"
+            })
+        return 200, status
+
+    def _results(self, batch_id):
+        """tar.gz con los resultados por operación, como los publica Mailchimp."""
+        with self._lock:
+            self.requests["results"] += 1
+            _, _, operation_ids, errored = self._batches[batch_id]
+        results = [
+            {"operation_id": operation_id, "status_code": 400,
+             "response": json.dumps({"title": "Invalid Resource", "detail": "Simulated error"})}
+            if operation_id in errored else
+            {"operation_id": operation_id, "status_code": 200, "response": "{}"}
+            for operation_id in operation_ids
+        ]
+        data = json.dumps(results).encode()
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+            member = tarfile.TarInfo(f"{batch_id}/results.json")
+            member.size = len(data)
+            archive.addfile(member, io.BytesIO(data))
+        return buffer.getvalue()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                time.sleep(fake.latency)
+                if self.path.rstrip("/") != "/3.0/batches":
+                    return self._send_json(404, {"title": "Resource Not Found"})
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                self._send_json(*fake._start(body))
+
+            def do_GET(self):
+                time.sleep(fake.latency)
+                url = urlsplit(self.path)
+                match = re.fullmatch(r"/3\.0/batches/(\w+)", url.path)
+                if match:
+                    return self._send_json(*fake._status(match.group(1)))
+                match = re.fullmatch(r"/3\.0/lists/(\w+)/members", url.path)
+                if match:
+                    return self._send_json(*fake._list_members(match.group(1), parse_qs(url.query)))
+                match = re.fullmatch(r"/results/(\w+)\.tar\.gz", self.path)
+                if match:
+                    data = fake._results(match.group(1))
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-gzip")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                self._send_json(404, {"title": "Resource Not Found"})
+
+            def _send_json(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+class FakeWorksheet:
+    def __init__(self, sheet_id):
+        self.id = sheet_id
+        self.rows = []
+
+class FakeSpreadsheet:
+    """
+    Hoja de cálculo en memoria con los métodos de gspread que usa SheetsWriter.
+    Cada petición espera latency segundos y falla con probabilidad failure_rate.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.rows_written = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._worksheets = {}
+
+    def worksheet(self, name):
+        with self._lock:
+            if name not in self._worksheets:
+                self._worksheets[name] = FakeWorksheet(len(self._worksheets))
+            return self._worksheets[name]
+
+    def _request(self):
+        time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if self._random.random() < self.failure_rate:
+                raise RuntimeError("Simulated Google Sheets error")
+
+    def batch_update(self, body):
+        """Admite peticiones appendCells: las filas se añaden al final de cada hoja."""
+        self._request()
+        by_id = {worksheet.id: worksheet for worksheet in self._worksheets.values()}
+        with self._lock:
+            for request in body["requests"]:
+                append = request["appendCells"]
+                rows = [[cell["userEnteredValue"]["stringValue"] for cell in row["values"]] for row in append["rows"]]
+                by_id[append["sheetId"]].rows.extend(rows)
+                self.rows_written += len(rows)
@@ -0,0 +1,92 @@
+"""
+Generador de archivos de contactos sintéticos con el formato de las
+exportaciones (columnas A a L, sin cabecera): filas activas e inactivas,
+tiendas con prefijos 41/43/45 (con y sin cero delante) y otras que no se
+asignan a ninguna lista, celdas envueltas en ="...", emails inválidos, de
+dominios desechables y repetidos, y celdas vacías.
+
+    python -m bench.generate 100000 contacts.csv
+"""
+import argparse
+
+import numpy as np
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+import pandas as pd
+
+BANNERS = ["BRAVO", "Bravo", "CTOWN", "CTown", "KEY FOOD"]
+STORE_PREFIXES = ["43", "043", "45", "045", "41", "041", "47"]
+FIRST_NAMES = ["Maria", "Jose", "Ana", "Luis", "Carmen", "John", "Mary", "David"]
+LAST_NAMES = ["Garcia", "Rodriguez", "Martinez", "Lopez", "Smith", "Johnson", "Perez"]
+EMAIL_DOMAINS = ["gmail.com", "yahoo.com", "hotmail.com", "aol.com", "outlook.com", "mailinator.com"]
+# Columnas que pueden venir envueltas en ="..." en las exportaciones
+WRAPPED_COLUMNS = [1, 2, 9, 10]
+
+def generate_contacts(rows, seed=0, inactive_rate=0.2, bad_email_rate=0.02, wrapped_rate=0.1, duplicate_rate=0.02):
+    """DataFrame de rows contactos con columnas 0..11 (A..L), reproducible con seed."""
+    rng = np.random.default_rng(seed)
+    ids = pd.Series(np.arange(rows)).astype(str)
+    emails = "User" + ids + "@" + pd.Series(rng.choice(EMAIL_DOMAINS, rows, p=[0.4, 0.2, 0.15, 0.1, 0.1, 0.05]))
+    bad = rng.random(rows) < bad_email_rate
+    emails[bad] = np.where(rng.random(bad.sum()) < 0.5, "user" + ids[bad] + "gmail.com", None)
+    # Repetir el email de otra fila anterior (mismo cliente en varias filas o tiendas)
+    duplicate = np.flatnonzero(rng.random(rows) < duplicate_rate)
+    duplicate = duplicate[duplicate > 0]
+    emails[duplicate] = emails.to_numpy()[rng.integers(0, duplicate)]
+
+    df = pd.DataFrame({
+        0: rng.choice(BANNERS, rows, p=[0.4, 0.1, 0.3, 0.1, 0.1]),
+        1: pd.Series(rng.choice(STORE_PREFIXES, rows)) + pd.Series(rng.integers(0, 100, rows)).astype(str).str.zfill(2),
+        2: emails,
+        3: rng.choice(FIRST_NAMES, rows),
+        4: rng.choice(LAST_NAMES, rows),
+        5: pd.Series(rng.integers(1, 9999, rows)).astype(str) + " Main St",
+        6: "New York",
+        7: "NY",
+        8: "US",
+        # Códigos postales como números: los menores de 10000 pierden los ceros a la izquierda
+        9: rng.integers(500, 99999, rows),
+        10: pd.Series(rng.integers(2000000000, 9999999999, rows)).astype(str),
+        11: np.where(rng.random(rows) < inactive_rate, "inactive", rng.choice(["active", "Active"], rows)),
+    })
+    for col in WRAPPED_COLUMNS:
+        # Solo se envuelven celdas con valor; las demás conservan su tipo (y las vacías, vacías)
+        wrapped = (rng.random(rows) < wrapped_rate) & df[col].notna()
+        df[col] = df[col].astype(object).where(~wrapped, '="' + df[col].astype(str) + '"')
+    return df
+
+def _xlsx_cell(worksheet, value):
+    """Celda de xlsx; los textos ="..." se guardan como texto, no como fórmula sin valor calculado."""
+    cell = WriteOnlyCell(worksheet, value)
+    if isinstance(value, str) and value.startswith("="):
+        cell.data_type = "s"
+    return cell
+
+def write_contacts(df, path):
+    """Guarda los contactos como csv o xlsx (según la extensión), sin cabecera."""
+    if path.endswith(".csv"):
+        df.to_csv(path, header=False, index=False)
+    elif path.endswith(".xlsx"):
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet()
+        for row in df.itertuples(index=False):
+            worksheet.append([_xlsx_cell(worksheet, value) for value in row])
+        workbook.save(path)
+    else:
+        raise ValueError(f"Unsupported file type: {path}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic contacts file (columns A-L, without headers)")
+    parser.add_argument("rows", type=int)
+    parser.add_argument("path", help="Output file, .csv or .xlsx")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--inactive-rate", type=float, default=0.2)
+    parser.add_argument("--bad-email-rate", type=float, default=0.02)
+    parser.add_argument("--wrapped-rate", type=float, default=0.1)
+    parser.add_argument("--duplicate-rate", type=float, default=0.02)
+    args = parser.parse_args(argv)
+    write_contacts(generate_contacts(args.rows, args.seed, args.inactive_rate, args.bad_email_rate,
+                                     args.wrapped_rate, args.duplicate_rate), args.path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark de extremo a extremo del motor de carga, sin conexión: genera
+archivos sintéticos de cada tamaño, los sube con engine.upload_file contra
+FakeMailchimpServer y FakeSpreadsheet y muestra el tiempo total y el de cada
+etapa (RunMetrics), más microbenchmarks de las funciones de lectura.
+
+    python -m bench.run --rows 1000 10000 100000 --output bench_output.json
+
+Todo se ejecuta en un directorio temporal, así que no toca el SyncIndex ni el
+JobJournal locales.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import timeit
+
+import pandas as pd
+
+import engine
+from bench.fakes import FakeMailchimpServer, FakeSpreadsheet
+from bench.generate import generate_contacts, write_contacts
+
+def best_of(function, repeat=5, number=1):
+    """Mejor tiempo por llamada de function en repeat rondas de number llamadas."""
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number
+
+def micro_benchmarks(df):
+    """Tiempos por llamada de las funciones de lectura sobre un bloque de df (DataFrame de generate_contacts)."""
+    chunk = df.head(engine.READ_CHUNK_ROWS).copy()
+    cleaned = engine._clean_chunk(chunk.copy())
+    rows = [
+        ("excel_column_names(12)", best_of(lambda: engine.excel_column_names(12), number=1000), None),
+        ("excel_column_names(16384)", best_of(lambda: engine.excel_column_names(16384)), None),
+        ("_clean_chunk", best_of(lambda: engine._clean_chunk(chunk.copy())), len(chunk)),
+        ("pad_zip_codes", best_of(lambda: engine.pad_zip_codes(cleaned["J"])), len(cleaned)),
+        ("route_contacts", best_of(lambda: engine.route_contacts(cleaned)), len(cleaned)),
+        ("normalize_emails", best_of(lambda: engine.normalize_emails(cleaned["C"], engine.load_domain_blocklist())), len(cleaned)),
+    ]
+    return [
+        {"function": name, "seconds": round(seconds, 6), "rows": size,
+         "rows_per_second": round(size / seconds, 1) if size else None}
+        for name, seconds, size in rows
+    ]
+
+def run_upload(path, args):
+    """Sube path contra los servidores falsos; devuelve (segundos, resultados, filas de RunMetrics, peticiones)."""
+    spreadsheet = FakeSpreadsheet(args.sheets_latency, args.sheets_failure_rate)
+    with FakeMailchimpServer(args.mailchimp_latency, args.batch_seconds, args.seconds_per_operation,
+                             args.start_failure_rate, args.operation_error_rate) as server:
+        client = server.mailchimp_client(engine.get_http_session())
+        engine.get_mailchimp_client = lambda: client
+        engine.get_spreadsheet = lambda: spreadsheet
+        engine.get_worksheet = spreadsheet.worksheet
+        metrics = engine.RunMetrics(run_id=f"bench-{os.path.basename(path)}")
+        start = time.perf_counter()
+        results = engine.upload_file(path, upsert=args.upsert, chunk_size=args.chunk_size, max_workers=args.workers,
+                                     on_event=lambda event: None, adaptive=args.adaptive, metrics=metrics,
+                                     sync=args.sync, max_in_flight=args.max_batches)
+        seconds = time.perf_counter() - start
+    rows, counters = metrics.summary()
+    requests = {f"mailchimp_{name}": count for name, count in server.requests.items()}
+    requests.update({"sheets_requests": spreadsheet.requests, "sheets_rows": spreadsheet.rows_written})
+    return seconds, results, rows, {**counters, **requests}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the upload pipeline")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="File sizes to benchmark (rows)")
+    parser.add_argument("--format", choices=["csv", "xlsx"], default="csv")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--upsert", action="store_true", help="Upload in upsert mode")
+    parser.add_argument("--sync", action="store_true", help="Upload in sync mode against the fake Mailchimp lists")
+    parser.add_argument("--chunk-size", type=int, default=engine.UPLOAD_CHUNK_SIZE)
+    parser.add_argument("--fixed-chunk-size", dest="adaptive", action="store_false")
+    parser.add_argument("--workers", type=int, default=engine.MAILCHIMP_MAX_WORKERS)
+    parser.add_argument("--max-batches", type=int, default=engine.MAILCHIMP_MAX_BATCHES_IN_FLIGHT)
+    parser.add_argument("--mailchimp-latency", type=float, default=0.05, help="Seconds per Mailchimp request")
+    parser.add_argument("--batch-seconds", type=float, default=1.0, help="Base processing time of a batch")
+    parser.add_argument("--seconds-per-operation", type=float, default=0.0005)
+    parser.add_argument("--start-failure-rate", type=float, default=0.0, help="Fraction of batches.start calls that fail")
+    parser.add_argument("--operation-error-rate", type=float, default=0.01, help="Fraction of operations that fail")
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="Seconds per Google Sheets request")
+    parser.add_argument("--sheets-failure-rate", type=float, default=0.0)
+    parser.add_argument("--no-upload", dest="upload", action="store_false", help="Only run the micro benchmarks")
+    parser.add_argument("--output", help="Write all results as JSON to this file")
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output) if args.output else None
+
+    report = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="krasdale-bench-") as workdir:
+        os.chdir(workdir)
+        for rows in args.rows:
+            start = time.perf_counter()
+            df = generate_contacts(rows, args.seed)
+            path = os.path.join(workdir, f"contacts_{rows}.{args.format}")
+            write_contacts(df, path)
+            print(f"\n== {rows} rows ({args.format}, generated in {time.perf_counter() - start:.1f}s)", flush=True)
+
+            entry = {"rows": rows, "format": args.format, "micro": micro_benchmarks(df)}
+            print(pd.DataFrame(entry["micro"]).to_string(index=False), flush=True)
+            if args.upload:
+                seconds, results, stages, counters = run_upload(path, args)
+                entry.update({"seconds": round(seconds, 3), "rows_per_second": round(rows / seconds, 1),
+                              "results": results, "stages": stages, "counters": counters})
+                print(f"\nEnd to end: {seconds:.2f}s ({rows / seconds:.0f} rows/s)")
+                print(pd.DataFrame(stages).to_string(index=False))
+                print(" | ".join(f"{name}: {value}" for name, value in counters.items()), flush=True)
+            report.append(entry)
+        os.chdir(cwd)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"args": vars(args), "runs": report}, f, indent=2, default=str)
+        print(f"\nResults written to {output}")
+
+if __name__ == "__main__":
+    main()
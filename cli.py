@@ -0,0 +1,119 @@
+"""
+Punto de entrada por línea de comandos, sin Streamlit:
+
+    python cli.py upload contacts.xlsx         # sube el archivo en este proceso
+    python cli.py submit contacts.xlsx         # lo encola para un worker
+    python cli.py worker --concurrency 2       # procesa la cola
+    python cli.py status [QUEUE_ID]            # estado de la cola o de un trabajo
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+
+import pandas as pd
+
+from engine import MAILCHIMP_MAX_BATCHES_IN_FLIGHT, MAILCHIMP_MAX_WORKERS, UPLOAD_CHUNK_SIZE, file_sha256, upload_file
+from worker import JOB_INBOX_DIR, WORKER_CONCURRENCY, JobQueue, run_worker
+
+def print_event(event):
+    """on_event para la consola."""
+    if event["type"] == "message":
+        print(f"[{event['level']}] {event['text']}", flush=True)
+    elif event["type"] == "progress":
+        print(" | ".join(f"{name}: {event['done'][name]}/{event['totals'][name]}" for name in event["totals"]), flush=True)
+    elif event["type"] == "table":
+        print(f"{event['title']}:")
+        print(pd.DataFrame(event["rows"]).to_string(index=False), flush=True)
+
+def print_results(results):
+    for list_name, res in results.items():
+        print(f"List '{list_name}': {res['success']} contacts added, {res['failed']} failed, {res['skipped']} unchanged, {res.get('duplicates', 0)} duplicates, {res.get('other_list', 0)} already sent to another list, {res.get('archived', 0)} archived.")
+
+def copy_to_inbox(path):
+    """Copia el archivo a JOB_INBOX_DIR con su hash como nombre, para que el worker no dependa del original."""
+    os.makedirs(JOB_INBOX_DIR, exist_ok=True)
+    extension = os.path.splitext(path)[1].lower()
+    target = os.path.join(JOB_INBOX_DIR, f"{file_sha256(path)}{extension}")
+    if not os.path.exists(target):
+        shutil.copyfile(path, target)
+    return target
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Krasdale - Spreadsheet to MailChimp")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Also log every timing span as JSON (krasdale.metrics logger)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    upload = commands.add_parser("upload", help="Upload a xlsx or csv file (without headers) in this process")
+    submit = commands.add_parser("submit", help="Queue a xlsx or csv file (without headers) for a worker")
+    for command in (upload, submit):
+        command.add_argument("file")
+        command.add_argument("--no-upsert", dest="upsert", action="store_false",
+                             help="Send every contact instead of only new or changed ones")
+        command.add_argument("--chunk-size", type=int, default=UPLOAD_CHUNK_SIZE,
+                             help="Contacts in the first Mailchimp batch")
+        command.add_argument("--fixed-chunk-size", dest="adaptive", action="store_false",
+                             help="Keep every batch at --chunk-size instead of adapting it to Mailchimp's response times")
+        command.add_argument("--sync", action="store_true",
+                             help="Compare with the current Mailchimp lists: send only new or changed contacts "
+                                  "and archive the ones no longer active")
+    upload.add_argument("--workers", type=int, default=MAILCHIMP_MAX_WORKERS,
+                        help="Concurrent Mailchimp requests")
+    upload.add_argument("--max-batches", type=int, default=MAILCHIMP_MAX_BATCHES_IN_FLIGHT,
+                        help="Mailchimp batches pending at the same time")
+
+    worker = commands.add_parser("worker", help="Process queued uploads until interrupted")
+    worker.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY,
+                        help="Files processed at the same time")
+    worker.add_argument("--poll-interval", type=float, default=2.0,
+                        help="Seconds between queue checks when idle")
+
+    status = commands.add_parser("status", help="Show recent uploads, or the events of one upload")
+    status.add_argument("queue_id", nargs="?", type=int)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    if args.verbose:
+        logging.getLogger("krasdale.metrics").setLevel(logging.DEBUG)
+
+    if args.command == "upload":
+        try:
+            results = upload_file(args.file, upsert=args.upsert, chunk_size=args.chunk_size,
+                                  max_workers=args.workers, on_event=print_event, adaptive=args.adaptive,
+                                  sync=args.sync, max_in_flight=args.max_batches)
+        except ValueError as e:
+            print(f"[error] {e}", file=sys.stderr)
+            return 1
+        print_results(results)
+    elif args.command == "submit":
+        queue_id = JobQueue().submit(copy_to_inbox(args.file), os.path.basename(args.file),
+                                     upsert=args.upsert, chunk_size=args.chunk_size, adaptive=args.adaptive,
+                                     sync=args.sync)
+        print(f"Queued upload {queue_id}")
+    elif args.command == "worker":
+        try:
+            run_worker(args.concurrency, args.poll_interval)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "status":
+        job_queue = JobQueue()
+        if args.queue_id is None:
+            for job in job_queue.recent():
+                print(f"{job['queue_id']:>5}  {job['status']:<8}  {job['submitted_at']}  {job['file_name']}")
+            return 0
+        job = job_queue.get(args.queue_id)
+        if job is None:
+            print(f"Upload {args.queue_id} not found", file=sys.stderr)
+            return 1
+        for _, event in job_queue.events(args.queue_id):
+            print_event(event)
+        print(json.dumps({key: value for key, value in job.items() if key != "results"}, indent=2))
+        if job["results"]:
+            print_results(job["results"])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1944 @@
+"""
+Motor de carga de contactos a Mailchimp, independiente de la interfaz.
+Lo usan la app de Streamlit (a través de la cola de trabajos de worker.py),
+el worker en segundo plano y la línea de comandos (cli.py). El progreso se
+comunica con un callback on_event en lugar de llamadas a st.*.
+"""
+import pandas as pd
+import numpy as np
+import mailchimp_marketing as MailchimpMarketing
+from mailchimp_marketing.api_client import ApiClientError
+import contextlib
+import functools
+import json
+import hashlib
+import hmac
+import logging
+import os
+import re
+import sqlite3
+import tarfile
+import queue
+import time
+import threading
+import tomllib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlsplit
+import requests
+import openpyxl
+import gspread
+from google.oauth2.service_account import Credentials
+
+logger = logging.getLogger("krasdale")
+metrics_logger = logging.getLogger("krasdale.metrics")
+
+def _load_secrets():
+    """
+    Lee los mismos secrets.toml que st.secrets (el global y el del proyecto),
+    para que el motor funcione también fuera de Streamlit.
+    """
+    secrets = {}
+    for path in (Path.home() / ".streamlit" / "secrets.toml", Path.cwd() / ".streamlit" / "secrets.toml"):
+        if path.exists():
+            secrets.update(tomllib.loads(path.read_text()))
+    return secrets
+
+_SECRETS = _load_secrets()
+
+def secret(key, default=None, required=False):
+    """
+    Valor de configuración: variable de entorno (en mayúsculas o con el nombre
+    tal cual, como las exporta Streamlit) o secrets.toml. Con required, falta
+    de valor es un error, como lo era st.secrets[key].
+    """
+    value = os.environ.get(key.upper(), os.environ.get(key, _SECRETS.get(key, default)))
+    if value is None and required:
+        raise KeyError(f"Missing secret {key!r}: set it in .streamlit/secrets.toml or in the {key.upper()} environment variable")
+    return value
+
+def excel_column_names(n):
+    """Generate Excel-style column names (A, B, ..., Z, AA, AB, ...) for n columns."""
+    names = []
+    for i in range(n):
+        name = ''
+        col = i
+        while True:
+            name = chr(65 + (col % 26)) + name
+            col = col // 26 - 1
+            if col < 0:
+                break
+        names.append(name)
+    return names
+# Mailchimp config
+MAILCHIMP_API_KEY = secret("mailchimp_api_key", required=True)
+MAILCHIMP_SERVER = secret("mailchimp_server", required=True)
+LISTS = {
+    "Bravo NY": "0a06e5f3d3",
+    "Bravo FL": "eab6821d7c",
+    "CTown": "7a827d6afc"
+}
+# Reglas de asignación a listas: (banner en columna A, prefijos de tienda en columna B, lista)
+ROUTING_TABLE = [
+    ("BRAVO", ("43", "043"), "Bravo NY"),
+    ("BRAVO", ("45", "045"), "Bravo FL"),
+    ("CTOWN", ("41", "041"), "CTown"),
+]
+LIST_DTYPE = pd.CategoricalDtype(categories=list(LISTS))
+# Campos de Mailchimp y columna del archivo de la que sale cada uno
+EXTRA_FIELDS_MAP = {
+    "Bravo NY": {
+        "email": "C",
+        "FNAME": "D",
+        "LNAME": "E",
+        "ADDRESS": "F",
+        "ZIPCODE": "J",
+        "PHONE": "K"
+    },
+    "Bravo FL": {
+        "email": "C",
+        "FNAME": "D",
+        "LNAME": "E",
+        "ADDRESS": "F",
+        "MMERGE10": "J",  # Full Address Zip
+        "MMERGE11": "J",   # Zip
+        "PHONE": "K"
+    },
+    "CTown": {
+        "email": "C",
+        "FNAME": "D",
+        "LNAME": "E",
+        "ADDRESS": "F",
+        "ZIPCODE": "J",
+        "PHONE": "K"
+    }
+}
+# Columnas que se conservan al leer el archivo: las de los mapas de campos,
+# las de asignación a listas (A, B) y la de estado (L)
+USED_COLUMNS = sorted({"A", "B", "L"} | {col for fields in EXTRA_FIELDS_MAP.values() for col in fields.values()})
+# Filas por bloque al leer el archivo
+READ_CHUNK_ROWS = 20000
+# Contactos del primer batch de Mailchimp; BatchPlanner ajusta los siguientes
+UPLOAD_CHUNK_SIZE = 700
+# Límites de BatchPlanner: tamaño mínimo y máximo de un batch (operaciones y
+# bytes del payload serializado) y duración objetivo de cada batch en Mailchimp
+BATCH_MIN_OPERATIONS = 100
+BATCH_MAX_OPERATIONS = int(secret("batch_max_operations", 10000))
+BATCH_MAX_BYTES = int(secret("batch_max_bytes", 4 * 1024 * 1024))
+BATCH_TARGET_SECONDS = float(secret("batch_target_seconds", 120))
+# Segundos que se espera a cada batch de Mailchimp antes de darlo por fallido
+BATCH_TIMEOUT = float(secret("batch_timeout", 3600))
+# Peticiones HTTP simultáneas a Mailchimp por carga (Mailchimp admite hasta 10 conexiones simultáneas)
+MAILCHIMP_MAX_WORKERS = int(secret("mailchimp_max_workers", 4))
+# Batches enviados a Mailchimp y aún sin terminar por carga; mientras Mailchimp los
+# procesa no ocupan conexiones, así que la ventana puede ser mayor que el pool HTTP
+MAILCHIMP_MAX_BATCHES_IN_FLIGHT = int(secret("mailchimp_max_batches_in_flight", 12))
+# Webhook de batch opcional: URL pública que Mailchimp llama al terminar cada batch,
+# redirigida al puerto local donde escucha BatchWebhookReceiver
+MAILCHIMP_BATCH_WEBHOOK_URL = secret("mailchimp_batch_webhook_url")
+MAILCHIMP_BATCH_WEBHOOK_PORT = int(secret("mailchimp_batch_webhook_port", 8502))
+# Token secreto que se añade a la URL registrada; el receptor rechaza las peticiones sin él
+MAILCHIMP_BATCH_WEBHOOK_TOKEN = secret("mailchimp_batch_webhook_token")
+# Segundos que se guardan las notificaciones de batches que ningún tracker sigue
+MAILCHIMP_BATCH_WEBHOOK_RETENTION = 3600
+# Dominios rechazados al validar emails (desechables o sin servidor de correo), uno por línea
+EMAIL_BLOCKLIST_PATH = secret("email_blocklist_path", str(Path(__file__).with_name("disposable_domains.txt")))
+# Índice local de contactos ya sincronizados (modo upsert)
+SYNC_INDEX_PATH = secret("sync_index_path", "sync_index.sqlite3")
+# Copia local de los miembros de cada lista de Mailchimp (modo sync); se vuelve
+# a descargar cuando tiene más de LIST_SNAPSHOT_MAX_AGE segundos
+LIST_SNAPSHOT_PATH = secret("list_snapshot_path", "list_snapshots.sqlite3")
+LIST_SNAPSHOT_MAX_AGE = float(secret("list_snapshot_max_age", 12 * 3600))
+# Miembros por página al descargar una lista (máximo de la API: 1000)
+LIST_SNAPSHOT_PAGE_SIZE = 1000
+# Diario de trabajos de carga, para reanudarlos tras un reinicio
+JOB_JOURNAL_PATH = secret("job_journal_path", "upload_jobs.sqlite3")
+# Segundos que una conexión SQLite espera a que otro proceso o hilo libere la base
+# (el JobJournal comparte archivo con la cola de worker.py)
+SQLITE_TIMEOUT = 30
+
+# Google Sheets config
+GOOGLE_SHEETS_CREDENTIALS = {
+    "type": "service_account",
+    "project_id": "main-guild-437619-m2",
+    "private_key_id": secret("private_key_id", required=True),
+    "private_key": secret("google_credentials", required=True),
+    "client_email": "systems-specialist@main-guild-437619-m2.iam.gserviceaccount.com",
+    "client_id": "101632772111851962527",
+    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+    "token_uri": "https://oauth2.googleapis.com/token",
+    "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+    "client_x509_cert_url": "https://www.googleapis.com/robot/v1/metadata/x509/systems-specialist%40main-guild-437619-m2.iam.gserviceaccount.com",
+    "universe_domain": "googleapis.com"
+}
+
+GOOGLE_SHEET_ID = "15adUqyAx4bO-Gz7RweIxxSHziKn3iVwa5e8Ac-iypf0"
+SHEET_NAMES = {
+    "Bravo NY": "Bravo NY",
+    "Bravo FL": "Bravo FL", 
+    "CTown": "CTOWN"
+}
+# Límites de escritura: celdas por petición values.batchUpdate y peticiones por minuto
+SHEETS_MAX_CELLS_PER_REQUEST = 40000
+SHEETS_WRITES_PER_MINUTE = 50
+# Clientes compartidos: se crean una vez por proceso (y por tanto se conservan
+# entre reruns de Streamlit) para no repetir el intercambio OAuth ni los
+# handshakes TLS en cada carga
+
+@functools.cache
+def get_http_session():
+    """Sesión HTTP con pool de conexiones, compartida por todos los hilos de carga."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=MAILCHIMP_MAX_WORKERS * 2)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def _pooled_request(api_client, session):
+    """
+    Sustituye ApiClient.request, que abre una conexión nueva por llamada con
+    requests.get/post, por una versión que reutiliza las conexiones de session.
+    """
+    def request(method, url, query_params=None, headers=None, body=None):
+        auth = ('user', api_client.api_key) if api_client.is_basic_auth else None
+        data = json.dumps(body) if method in ("POST", "PUT", "PATCH") else None
+        return session.request(method, url, params=query_params, headers=headers, data=data,
+                               auth=auth, timeout=api_client.timeout)
+    return request
+
+@functools.cache
+def get_mailchimp_client():
+    """Cliente de Mailchimp configurado, con las peticiones sobre la sesión compartida."""
+    client = MailchimpMarketing.Client()
+    client.set_config({
+        "api_key": MAILCHIMP_API_KEY,
+        "server": MAILCHIMP_SERVER
+    })
+    client.api_client.request = _pooled_request(client.api_client, get_http_session())
+    return client
+
+@functools.cache
+def get_gspread_client():
+    """
+    Cliente de gspread autorizado con la cuenta de servicio. Su AuthorizedSession
+    renueva el token de acceso automáticamente cuando caduca.
+    """
+    scopes = [
+        'https://www.googleapis.com/auth/spreadsheets',
+        'https://www.googleapis.com/auth/drive'
+    ]
+    creds = Credentials.from_service_account_info(GOOGLE_SHEETS_CREDENTIALS, scopes=scopes)
+    return gspread.authorize(creds)
+
+@functools.cache
+def get_spreadsheet():
+    """Hoja de cálculo de resultados, abierta una sola vez."""
+    return get_gspread_client().open_by_key(GOOGLE_SHEET_ID)
+
+@functools.cache
+def get_worksheet(sheet_name):
+    """Hoja de resultados abierta una sola vez por nombre."""
+    return get_spreadsheet().worksheet(sheet_name)
+class RunMetrics:
+    """
+    Tiempos y contadores de una carga, por etapa (lectura, limpieza, asignación,
+    payloads, envío de batches, sondeo, resultados y escritura en Sheets).
+    Los spans del mismo nombre se acumulan: llamadas, segundos, máximo y
+    elementos procesados. Cada span y el resumen final se registran como JSON
+    en el logger krasdale.metrics. Se usa desde varios hilos, así que la suma
+    de los spans puede superar la duración total.
+    """
+
+    def __init__(self, run_id=None):
+        self.run_id = run_id or os.urandom(4).hex()
+        self._spans = {}  # nombre -> [llamadas, segundos, máximo, elementos]
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, items=0):
+        """Mide el bloque with; si falla cuenta el tiempo pero no los elementos."""
+        start = time.perf_counter()
+        processed = 0
+        try:
+            yield
+            processed = items
+        finally:
+            self.record(name, time.perf_counter() - start, processed)
+
+    def record(self, name, seconds, items=0):
+        """Añade una medida a la etapa name (p. ej. la duración de un batch informada por Mailchimp)."""
+        with self._lock:
+            span = self._spans.setdefault(name, [0, 0.0, 0.0, 0])
+            span[0] += 1
+            span[1] += seconds
+            span[2] = max(span[2], seconds)
+            span[3] += items
+        metrics_logger.debug(json.dumps({"run": self.run_id, "span": name, "seconds": round(seconds, 4), "items": items}))
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def summary(self):
+        """Filas del resumen por etapa, en el orden en que empezó cada una, y los contadores."""
+        with self._lock:
+            spans = {name: list(span) for name, span in self._spans.items()}
+            counters = dict(self._counters)
+        rows = [{
+            "stage": name,
+            "calls": calls,
+            "seconds": round(seconds, 3),
+            "max_seconds": round(longest, 3),
+            "items": items,
+            "items_per_second": round(items / seconds, 1) if items and seconds else None
+        } for name, (calls, seconds, longest, items) in spans.items()]
+        rows.append({"stage": "total", "calls": 1, "seconds": round(time.perf_counter() - self._started, 3),
+                     "max_seconds": None, "items": None, "items_per_second": None})
+        return rows, counters
+
+    def report(self, on_event):
+        """Registra el resumen como JSON y lo envía como tablas a on_event."""
+        rows, counters = self.summary()
+        metrics_logger.info(json.dumps({"run": self.run_id, "summary": rows, "counters": counters}))
+        on_event({"type": "table", "title": "Run timings", "rows": rows, "expanded": True})
+        if counters:
+            on_event({"type": "table", "title": "Run counters",
+                      "rows": [{"counter": name, "value": value} for name, value in counters.items()]})
+
+def sheet_row(contact):
+    """Fila de resultados de un contacto: email, nombre, teléfono y ✅/❌."""
+    merge_fields = contact.get('merge_fields', {})
+    check_status = "✅" if contact.get('uploaded', False) else "❌"
+    return [contact.get('email_address', ''), merge_fields.get('FNAME', ''), merge_fields.get('PHONE', ''), check_status]
+
+class TokenBucket:
+    """Limitador de ritmo: rate tokens por segundo, con hasta capacity acumulados."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Bloquea hasta que haya tokens disponibles y los consume."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_time = (tokens - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+class SheetsWriter:
+    """
+    Escribe en Google Sheets los resultados a medida que terminan los bloques.
+    Un hilo en segundo plano junta cada flush_interval segundos las filas
+    pendientes de todas las hojas y las añade al final de cada hoja con
+    peticiones appendCells en un solo batchUpdate, en lotes de hasta max_cells
+    celdas y respetando la cuota de escritura de Sheets.
+    Las worksheets se resuelven al crearlo, desde el hilo que lo crea.
+    """
+
+    def __init__(self, list_names, report, flush_interval=5.0, max_cells=SHEETS_MAX_CELLS_PER_REQUEST, metrics=None):
+        self.report = report
+        self.metrics = metrics or RunMetrics()
+        self.flush_interval = flush_interval
+        self.max_cells = max_cells
+        self.saved = {list_name: 0 for list_name in list_names}
+        self.unsaved = {list_name: 0 for list_name in list_names}
+        self._spreadsheet = get_spreadsheet()
+        self._worksheets = {list_name: get_worksheet(SHEET_NAMES[list_name]) for list_name in list_names}
+        self._bucket = TokenBucket(SHEETS_WRITES_PER_MINUTE / 60, capacity=5)
+        self._pending = []  # (list_name, fila)
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, list_name, rows):
+        """Encola filas de resultados de una lista."""
+        with self._lock:
+            self._pending.extend((list_name, row) for row in rows)
+
+    def close(self):
+        """Escribe lo que quede pendiente y detiene el hilo."""
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._flush()
+            with self._lock:
+                finished = self._closed and not self._pending
+            if finished:
+                return
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        max_rows = max(1, self.max_cells // 4)
+        for start in range(0, len(pending), max_rows):
+            batch = pending[start:start + max_rows]
+            try:
+                with self.metrics.span("sheets_write", items=len(batch)):
+                    self._write(batch)
+                self._failures = 0
+                for list_name, _ in batch:
+                    self.saved[list_name] += 1
+            except Exception as e:
+                self._failures += 1
+                if self._failures < 3:
+                    self.metrics.count("sheets_retries")
+                    self.report("warning", f"Google Sheets write failed, retrying: {str(e)}")
+                    # Devolver a la cola lo que falta por escribir
+                    with self._lock:
+                        self._pending[:0] = pending[start:]
+                    time.sleep(2 ** self._failures)
+                else:
+                    self.report("error", f"❌ Error saving {len(batch)} records to Google Sheets: {str(e)}")
+                    self._failures = 0
+                    for list_name, _ in batch:
+                        self.unsaved[list_name] += 1
+                    continue
+                return
+
+    def _write(self, batch):
+        rows_by_list = {}
+        for list_name, row in batch:
+            rows_by_list.setdefault(list_name, []).append(row)
+        # appendCells añade las filas en el servidor, tras la última fila con datos
+        # de cada hoja (y amplía la cuadrícula si hace falta): no pisa lo que
+        # escriban a la vez otros trabajos o personas
+        self._bucket.acquire()
+        self._spreadsheet.batch_update({"requests": [
+            {"appendCells": {
+                "sheetId": self._worksheets[list_name].id,
+                "rows": [
+                    {"values": [{"userEnteredValue": {"stringValue": str(value)}} for value in row]}
+                    for row in rows
+                ],
+                "fields": "userEnteredValue"
+            }}
+            for list_name, rows in rows_by_list.items()
+        ]})
+
+def _rows_to_frame(rows, start):
+    """
+    DataFrame de filas de openpyxl. Se mantiene dtype object para que una celda
+    vacía no convierta en float una columna de enteros (p. ej. 7030 -> '7030.0').
+    """
+    chunk = pd.DataFrame(rows, index=range(start, start + len(rows)), dtype=object)
+    return chunk.where(chunk.notna(), np.nan)
+
+def _iter_raw_chunks(uploaded_file, chunk_rows):
+    """
+    Lee el archivo (sin cabecera) por bloques de chunk_rows filas.
+    xlsx: openpyxl en modo read_only, que no carga el libro entero en memoria.
+    csv: pandas con chunksize; todo se lee como texto para conservar ceros a la izquierda.
+    Cada bloque mantiene como índice el número de fila (base 0) en el archivo.
+    """
+    if uploaded_file.name.endswith('.xlsx'):
+        workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+        try:
+            rows = []
+            start = 0
+            for row in workbook.worksheets[0].iter_rows(values_only=True):
+                rows.append(row)
+                if len(rows) == chunk_rows:
+                    yield _rows_to_frame(rows, start)
+                    start += len(rows)
+                    rows = []
+            if rows:
+                yield _rows_to_frame(rows, start)
+        finally:
+            workbook.close()
+    elif uploaded_file.name.endswith('.csv'):
+        yield from pd.read_csv(uploaded_file, header=None, dtype=str, on_bad_lines='skip', chunksize=chunk_rows)
+
+def _clean_chunk(chunk):
+    """Nombra las columnas como en Excel, conserva solo USED_COLUMNS y quita los envoltorios ="..."."""
+    chunk.columns = excel_column_names(chunk.shape[1])
+    chunk = chunk[[col for col in USED_COLUMNS if col in chunk.columns]].copy()
+    for col in chunk.columns:
+        if chunk[col].dtype != object:
+            continue
+        values = chunk[col]
+        try:
+            wrapped = values.str.startswith('="', na=False) & values.str.endswith('"', na=False)
+        except AttributeError:
+            continue  # Columna sin textos (p. ej. solo fechas)
+        if wrapped.any():
+            chunk.loc[wrapped, col] = values[wrapped].str[2:-1]
+    return chunk
+
+def read_contacts(uploaded_file, chunk_rows=READ_CHUNK_ROWS, metrics=None, limit=None, keep_inactive=False):
+    """
+    Lee el archivo subido por bloques, limpiando y filtrando cada bloque antes
+    de acumularlo para no tener nunca el archivo completo en memoria.
+    Devuelve (df, has_status): si el archivo tiene columna L, df contiene solo
+    las filas 'active' que alguna regla de ROUTING_TABLE asigna a una lista, con
+    esa lista en la columna 'list'; si no, df es el primer bloque, para mostrarlo
+    como vista previa.
+    metrics: RunMetrics donde se miden las etapas read, clean y route.
+    limit: si se indica, deja de leer en cuanto tiene limit filas asignadas
+    (para vistas previas, sin recorrer el resto del archivo).
+    keep_inactive: conservar también las filas no activas que se asignan a una
+    lista (modo sync, para archivarlas); se distinguen con is_active.
+    """
+    metrics = metrics or RunMetrics()
+    kept = []
+    kept_rows = 0
+    raw_chunks = _iter_raw_chunks(uploaded_file, chunk_rows)
+    try:
+        while limit is None or kept_rows < limit:
+            # El bloque se lee dentro de next(); sus filas solo se conocen después
+            start = time.perf_counter()
+            chunk = next(raw_chunks, None)
+            if chunk is None:
+                break
+            metrics.record("read", time.perf_counter() - start, items=len(chunk))
+            with metrics.span("clean", items=len(chunk)):
+                chunk = _clean_chunk(chunk)
+            if 'L' not in chunk.columns:
+                return chunk, False
+            with metrics.span("route", items=len(chunk)):
+                if not keep_inactive:
+                    chunk = chunk[is_active(chunk)]
+                chunk = chunk.assign(list=route_contacts(chunk))
+                chunk = chunk[chunk['list'].notna()]
+            if 'J' in chunk.columns:
+                with metrics.span("clean"):
+                    chunk['J'] = pad_zip_codes(chunk['J'])
+            kept.append(chunk)
+            kept_rows += len(chunk)
+    finally:
+        raw_chunks.close()  # Cierra el libro de openpyxl si no se leyó entero
+    if not kept:
+        return pd.DataFrame(columns=USED_COLUMNS).assign(list=pd.Series(dtype=LIST_DTYPE)), True
+    return pd.concat(kept), True
+
+def is_active(df):
+    """Máscara de las filas con estado 'active' en la columna L."""
+    return df['L'].astype(str).str.lower() == 'active'
+
+def pad_zip_codes(values):
+    """
+    Formatea los códigos postales (columna J) a 5 dígitos con ceros a la izquierda.
+    Las celdas vacías siguen vacías (NaN), no el texto 'nan'.
+    """
+    zips = values.astype(str)
+    pad = values.notna() & zips.str.isdigit() & (zips.str.len() < 5)
+    return zips.where(~pad, zips.str.zfill(5)).where(values.notna(), np.nan)
+
+def route_contacts(df):
+    """
+    Asigna cada fila a una lista según ROUTING_TABLE en una sola pasada.
+    Las columnas A y B se normalizan una vez y se convierten en códigos
+    categóricos; cada (banner, prefijo) se resuelve con una tabla numpy.
+    Si varias reglas coinciden gana la primera de la tabla.
+    Devuelve una Series categórica (LIST_DTYPE) con la lista o NaN si ninguna regla aplica.
+    """
+    banners = sorted({banner for banner, _, _ in ROUTING_TABLE})
+    banner_codes = pd.Categorical(df['A'].astype(str).str.upper(), categories=banners).codes
+    stores = df['B'].astype(str)
+
+    rule_idx = np.full(len(df), len(ROUTING_TABLE))  # len(ROUTING_TABLE) = sin regla
+    for length in sorted({len(prefix) for _, prefixes, _ in ROUTING_TABLE for prefix in prefixes}):
+        prefixes = sorted({prefix for _, rule_prefixes, _ in ROUTING_TABLE for prefix in rule_prefixes if len(prefix) == length})
+        lookup = np.full((len(banners), len(prefixes)), len(ROUTING_TABLE))
+        for idx, (banner, rule_prefixes, _) in reversed(list(enumerate(ROUTING_TABLE))):
+            for prefix in rule_prefixes:
+                if len(prefix) == length:
+                    lookup[banners.index(banner), prefixes.index(prefix)] = idx
+        prefix_codes = pd.Categorical(stores.str[:length], categories=prefixes).codes
+        hit = (banner_codes >= 0) & (prefix_codes >= 0)
+        rule_idx[hit] = np.minimum(rule_idx[hit], lookup[banner_codes[hit], prefix_codes[hit]])
+
+    list_codes = np.array([LIST_DTYPE.categories.get_loc(list_name) for _, _, list_name in ROUTING_TABLE] + [-1])
+    return pd.Series(pd.Categorical.from_codes(list_codes[rule_idx], dtype=LIST_DTYPE), index=df.index, name="list")
+
+def group_by_list(df):
+    """Vista agrupada de las filas ya asignadas: {list_name: DataFrame} con todas las listas de LISTS."""
+    groups = dict(tuple(df.groupby("list", observed=False)))
+    return {list_name: groups.get(list_name, df.iloc[:0]) for list_name in LISTS}
+
+# Sintaxis de email admitida (sobre el email ya normalizado en minúsculas)
+EMAIL_PATTERN = re.compile(
+    r"[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+    r"@(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}"
+)
+# Caracteres invisibles que llegan al copiar desde Excel o desde la web
+INVISIBLE_CHARACTERS = "[\u200b-\u200d\u2060\ufeff\u00ad]"
+
+@functools.cache
+def _read_domain_blocklist(path, mtime):
+    with open(path, encoding="utf-8") as f:
+        lines = (line.split("#", 1)[0].strip().lower() for line in f)
+        return frozenset(line for line in lines if line)
+
+def load_domain_blocklist(path=EMAIL_BLOCKLIST_PATH):
+    """Dominios de EMAIL_BLOCKLIST_PATH; se leen una vez por versión del archivo. Sin archivo no se bloquea nada."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return frozenset()
+    return _read_domain_blocklist(path, mtime)
+
+def normalize_emails(values, blocklist=frozenset()):
+    """
+    Normaliza y valida en bloque una columna de emails: normalización Unicode
+    NFKC, sin caracteres invisibles, espacios ni prefijo mailto:, en minúsculas.
+    Devuelve (emails, reasons): los emails normalizados ('' si la celda está
+    vacía) y el motivo de rechazo de cada uno ('missing', 'invalid syntax',
+    'blocked domain') o None si es válido.
+    """
+    emails = (
+        values.fillna("").astype(str)
+        .str.normalize("NFKC")
+        .str.replace(INVISIBLE_CHARACTERS, "", regex=True)
+        .str.strip()
+        .str.lower()
+        .str.removeprefix("mailto:")
+    )
+    reasons = pd.Series(None, index=values.index, dtype=object)
+    reasons[~emails.str.fullmatch(EMAIL_PATTERN) | (emails.str.len() > 254)] = "invalid syntax"
+    if blocklist:
+        reasons[reasons.isna() & emails.str.rsplit("@", n=1).str[-1].isin(blocklist)] = "blocked domain"
+    reasons[emails == ""] = "missing"
+    return emails, reasons
+
+def build_members(df, list_name, extra_fields_map=None, seen_emails=None):
+    """
+    Construye en bloque los contactos de una lista a partir del DataFrame.
+    Los emails se normalizan y validan con normalize_emails y cada dirección
+    se envía una sola vez: las repeticiones dentro de la lista se marcan como
+    duplicadas, y las que ya están en seen_emails (email -> lista que lo
+    aceptó antes) como duplicadas en otra lista. seen_emails se actualiza con
+    los emails aceptados.
+    Devuelve (members, valid_positions, contacts_data, invalid_rows):
+    members: payloads de Mailchimp de los contactos con email válido
+    valid_positions: índice en contacts_data de cada elemento de members
+    contacts_data: todos los contactos, para guardar en Google Sheets; los
+    duplicados llevan 'duplicate': True y los duplicados en otra lista,
+    'kept_in' con el nombre de esa lista
+    invalid_rows: DataFrame con la fila, el email, el motivo de los contactos
+    rechazados y, para los duplicados en otra lista, la lista que se quedó el email (kept_in)
+    """
+    field_map = (extra_fields_map or {}).get(list_name)
+    email_col = field_map['email'] if field_map else 'B'
+    merge_cols = {field: col for field, col in field_map.items() if field != 'email'} if field_map else {}
+
+    emails, reasons = normalize_emails(df[email_col], load_domain_blocklist())
+    accepted = reasons.isna()
+    duplicate = accepted & emails.where(accepted).duplicated()
+    reasons[duplicate] = "duplicate"
+    kept_in = pd.Series(None, index=emails.index, dtype=object)
+    if seen_emails is not None:
+        kept_in = emails.map(seen_emails).where(accepted & ~duplicate)
+        reasons[kept_in.notna()] = "duplicate in another list"
+    valid = reasons.isna().to_numpy()
+    if seen_emails is not None:
+        seen_emails.update(dict.fromkeys(emails[valid], list_name))
+
+    # Convertir cada columna una sola vez aunque la usen varios campos (p. ej. J);
+    # las celdas vacías quedan como '' en lugar de 'nan'
+    cleaned = {col: df[col].fillna("").astype(str).str.strip() for col in set(merge_cols.values())}
+    email_list = emails.tolist()
+    if merge_cols:
+        merge_list = pd.DataFrame({field: cleaned[col] for field, col in merge_cols.items()}).to_dict('records')
+    else:
+        merge_list = [{} for _ in email_list]
+
+    contacts_data = [
+        {'email_address': email, 'merge_fields': merge_fields, 'uploaded': False}
+        for email, merge_fields in zip(email_list, merge_list)
+    ]
+    for position in np.flatnonzero(duplicate.to_numpy()):
+        contacts_data[position]['duplicate'] = True
+    for position in np.flatnonzero(kept_in.notna().to_numpy()):
+        contacts_data[position]['kept_in'] = kept_in.iat[position]
+    valid_positions = np.flatnonzero(valid).tolist()
+    members = []
+    for position in valid_positions:
+        member_info = {"email_address": email_list[position], "status": "subscribed"}
+        if field_map:
+            member_info["merge_fields"] = merge_list[position]
+        members.append(member_info)
+
+    invalid_rows = pd.DataFrame({
+        "row": df.index[~valid] + 1,
+        "email": df[email_col][~valid].fillna("").to_numpy(),
+        "reason": reasons[~valid].to_numpy(),
+        "kept_in": kept_in[~valid].fillna("").to_numpy()
+    })
+    return members, valid_positions, contacts_data, invalid_rows
+
+def inactive_emails(df, list_name, extra_fields_map=None, active_emails=()):
+    """
+    Emails válidos y sin repetir de las filas no activas de una lista, en el
+    orden del archivo, sin los que siguen activos (active_emails). Son los
+    contactos que el modo sync archiva. No se aplica la lista de dominios
+    bloqueados: un contacto que ya está en Mailchimp se archiva igualmente.
+    """
+    field_map = (extra_fields_map or {}).get(list_name)
+    emails, reasons = normalize_emails(df[field_map['email'] if field_map else 'B'])
+    emails = emails[reasons.isna() & ~emails.isin(active_emails)]
+    return emails.drop_duplicates().tolist()
+
+def subscriber_hash(email):
+    """Hash con el que Mailchimp identifica a un miembro: md5 del email en minúsculas."""
+    return hashlib.md5(email.lower().encode()).hexdigest()
+
+# Partes de un merge field de tipo address, en el orden en que se comparan;
+# country no se incluye porque Mailchimp lo rellena aunque no se envíe
+ADDRESS_PARTS = ("addr1", "addr2", "city", "state", "zip")
+
+def merge_value(field, value):
+    """
+    Valor de un merge field normalizado para la huella, igual venga del archivo
+    o de Mailchimp. Se admiten los tipos text, number, zip, phone y address:
+    los address llegan de Mailchimp como objeto y se reducen a sus partes no
+    vacías; de los teléfonos (campos con PHONE en el nombre) solo cuentan los
+    dígitos, porque Mailchimp puede devolverlos con otro formato. El resto se
+    compara como texto sin espacios repetidos.
+    """
+    if isinstance(value, dict):
+        value = "  ".join(str(value[part]).strip() for part in ADDRESS_PARTS if str(value.get(part) or "").strip())
+    value = " ".join(str(value if value is not None else "").split())
+    if "PHONE" in field.upper():
+        value = re.sub(r"\D", "", value)
+    return value
+
+def member_fingerprint(member):
+    """Huella de los merge fields (normalizados con merge_value) de un contacto, para detectar cambios entre cargas."""
+    merge_fields = {field: merge_value(field, value) for field, value in member.get("merge_fields", {}).items()}
+    return hashlib.md5(json.dumps(merge_fields, sort_keys=True).encode()).hexdigest()
+
+class SyncIndex:
+    """
+    Índice local (SQLite) de los contactos ya sincronizados con cada lista:
+    subscriber hash -> huella de los merge fields que se enviaron.
+    Se usa en modo upsert para no reenviar contactos sin cambios.
+    """
+
+    def __init__(self, path=SYNC_INDEX_PATH):
+        self._conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS synced (
+                list_id TEXT NOT NULL,
+                subscriber_hash TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                synced_at TEXT NOT NULL,
+                PRIMARY KEY (list_id, subscriber_hash)
+            )
+        """)
+
+    def fingerprints(self, list_id):
+        """Devuelve {subscriber_hash: huella} de la lista."""
+        return dict(self._conn.execute(
+            "SELECT subscriber_hash, fingerprint FROM synced WHERE list_id = ?", (list_id,)
+        ))
+
+    def mark_synced(self, list_id, entries):
+        """Registra los pares (subscriber_hash, huella) subidos correctamente."""
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO synced VALUES (?, ?, ?, datetime('now'))",
+                [(list_id, hash_, fingerprint) for hash_, fingerprint in entries]
+            )
+
+    def forget(self, list_id, hashes):
+        """Quita de la lista los contactos archivados, para volver a enviarlos si reaparecen."""
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM synced WHERE list_id = ? AND subscriber_hash = ?",
+                [(list_id, hash_) for hash_ in hashes]
+            )
+
+    def close(self):
+        self._conn.close()
+
+class ListSnapshot:
+    """
+    Copia local (SQLite) de los miembros de cada lista de Mailchimp para el
+    modo sync: subscriber hash -> huella de los merge fields y estado.
+    Se descarga entera con fetch_list_members cuando caduca y, entre
+    descargas, se actualiza con lo que se sube en cada carga.
+    """
+
+    def __init__(self, path=LIST_SNAPSHOT_PATH):
+        self._conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    list_id TEXT PRIMARY KEY,
+                    fields TEXT NOT NULL,
+                    fetched_at TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS snapshot_members (
+                    list_id TEXT NOT NULL,
+                    subscriber_hash TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    PRIMARY KEY (list_id, subscriber_hash)
+                )
+            """)
+
+    def age(self, list_id, fields):
+        """Segundos desde la última descarga de la lista, o None si no hay copia o se hizo con otros merge fields."""
+        row = self._conn.execute(
+            "SELECT fields, (julianday('now') - julianday(fetched_at)) * 86400 FROM snapshots WHERE list_id = ?",
+            (list_id,)
+        ).fetchone()
+        if row is None or json.loads(row[0]) != sorted(fields):
+            return None
+        return row[1]
+
+    def members(self, list_id):
+        """Devuelve {subscriber_hash: (huella, estado)} de la lista."""
+        return {
+            hash_: (fingerprint, status)
+            for hash_, fingerprint, status in self._conn.execute(
+                "SELECT subscriber_hash, fingerprint, status FROM snapshot_members WHERE list_id = ?", (list_id,)
+            )
+        }
+
+    def replace(self, list_id, fields, entries):
+        """Sustituye la copia de la lista por una descarga nueva: entries son (subscriber_hash, huella, estado)."""
+        with self._conn:
+            self._conn.execute("DELETE FROM snapshot_members WHERE list_id = ?", (list_id,))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO snapshot_members VALUES (?, ?, ?, ?)",
+                [(list_id, *entry) for entry in entries]
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, datetime('now'))",
+                (list_id, json.dumps(sorted(fields)))
+            )
+
+    def update(self, list_id, entries):
+        """Registra los cambios subidos correctamente: entries son (subscriber_hash, huella, estado)."""
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO snapshot_members VALUES (?, ?, ?, ?)",
+                [(list_id, *entry) for entry in entries]
+            )
+
+    def close(self):
+        self._conn.close()
+
+def fetch_list_members(client, list_id, fields, max_workers=MAILCHIMP_MAX_WORKERS, page_size=LIST_SNAPSHOT_PAGE_SIZE):
+    """
+    Descarga todos los miembros de una lista de Mailchimp, con hasta
+    max_workers páginas pidiéndose a la vez. Solo se piden el hash, el estado
+    y los merge fields de fields, para que cada página sea pequeña.
+    Devuelve [(subscriber_hash, huella, estado)], con la huella calculada
+    como member_fingerprint sobre esos merge fields (ver merge_value para los
+    tipos de campo admitidos).
+    """
+    request_fields = ["total_items", "members.id", "members.status"] + [f"members.merge_fields.{field}" for field in fields]
+
+    def page(offset):
+        max_retries = 3
+        for retry_count in range(1, max_retries + 1):
+            try:
+                return client.lists.get_list_members_info(list_id, count=page_size, offset=offset, fields=request_fields)
+            except ApiClientError:
+                if retry_count == max_retries:
+                    raise
+                time.sleep(5 * retry_count)
+
+    first = page(0)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pages = [first, *pool.map(page, range(page_size, first["total_items"], page_size))]
+    return [
+        (
+            member["id"],
+            member_fingerprint({"merge_fields": {
+                field: member.get("merge_fields", {}).get(field, "") for field in fields
+            }}),
+            member["status"]
+        )
+        for response in pages for member in response["members"]
+    ]
+
+class JobJournal:
+    """
+    Diario local (SQLite) de los trabajos de carga, para poder reanudarlos.
+    Un trabajo es la carga de un archivo (identificado por su hash) en una lista;
+    por cada bloque se guardan las posiciones de sus contactos en contacts_data,
+    el ID del batch en Mailchimp, su estado (pending, submitted, done, failed) y
+    los errores por operación. Los bloques se añaden a medida que BatchPlanner
+    los corta: el trabajo está en 'planning' hasta que se corta el último, y
+    pasa a 'running' y después a 'done'. Se usa desde varios hilos.
+    """
+
+    def __init__(self, path=JOB_JOURNAL_PATH):
+        self._conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    file_hash TEXT NOT NULL,
+                    list_name TEXT NOT NULL,
+                    list_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_chunks (
+                    job_id INTEGER NOT NULL,
+                    chunk_idx INTEGER NOT NULL,
+                    positions TEXT NOT NULL,
+                    batch_id TEXT,
+                    status TEXT NOT NULL,
+                    errors TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (job_id, chunk_idx)
+                )
+            """)
+
+    def find_incomplete(self, file_hash, list_name):
+        """ID del último trabajo sin terminar de este archivo y lista, o None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE file_hash = ? AND list_name = ? AND status IN ('planning', 'running') "
+                "ORDER BY job_id DESC LIMIT 1",
+                (file_hash, list_name)
+            ).fetchone()
+        return row[0] if row else None
+
+    def create_job(self, file_hash, list_name, list_id):
+        """Registra un trabajo nuevo, todavía sin bloques."""
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "INSERT INTO jobs (file_hash, list_name, list_id, status, created_at) "
+                "VALUES (?, ?, ?, 'planning', datetime('now'))",
+                (file_hash, list_name, list_id)
+            ).lastrowid
+
+    def add_chunk(self, job_id, chunk_idx, positions, last=False):
+        """Añade un bloque al trabajo; last indica que no habrá más."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO job_chunks (job_id, chunk_idx, positions, status, updated_at) "
+                "VALUES (?, ?, ?, 'pending', datetime('now'))",
+                (job_id, chunk_idx, json.dumps(positions))
+            )
+            if last:
+                self._conn.execute("UPDATE jobs SET status = 'running' WHERE job_id = ?", (job_id,))
+
+    def set_planned(self, job_id):
+        """Marca que el trabajo ya no tendrá más bloques y lo cierra si todos terminaron."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = 'running' WHERE job_id = ? AND status = 'planning'", (job_id,))
+            self._close_if_done(job_id)
+
+    def load_chunks(self, job_id):
+        """Bloques de un trabajo, en orden, como diccionarios."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_idx, positions, batch_id, status, errors FROM job_chunks "
+                "WHERE job_id = ? ORDER BY chunk_idx",
+                (job_id,)
+            ).fetchall()
+        return [
+            {
+                "chunk_idx": chunk_idx,
+                "positions": json.loads(positions),
+                "batch_id": batch_id,
+                "status": status,
+                "errors": json.loads(errors) if errors else {}
+            }
+            for chunk_idx, positions, batch_id, status, errors in rows
+        ]
+
+    def set_batch(self, job_id, chunk_idx, batch_id):
+        """Anota el batch de Mailchimp que procesa un bloque."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE job_chunks SET batch_id = ?, status = 'submitted', updated_at = datetime('now') "
+                "WHERE job_id = ? AND chunk_idx = ?",
+                (batch_id, job_id, chunk_idx)
+            )
+
+    def finish_chunk(self, job_id, chunk_idx, status, errors=None):
+        """Cierra un bloque ('done' o 'failed'); el trabajo termina cuando está cortado y todos están 'done'."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE job_chunks SET status = ?, errors = ?, updated_at = datetime('now') "
+                "WHERE job_id = ? AND chunk_idx = ?",
+                (status, json.dumps(errors or {}), job_id, chunk_idx)
+            )
+            self._close_if_done(job_id)
+
+    def _close_if_done(self, job_id):
+        self._conn.execute(
+            "UPDATE jobs SET status = 'done' WHERE job_id = ? AND status = 'running' AND NOT EXISTS "
+            "(SELECT 1 FROM job_chunks WHERE job_id = ? AND status != 'done')",
+            (job_id, job_id)
+        )
+
+    def close(self):
+        self._conn.close()
+
+def _member_operation(list_id, position, contact, upsert, restore=False):
+    """
+    Operación de batch para un contacto: POST de alta o PUT idempotente por subscriber hash.
+    restore: el contacto está archivado en Mailchimp; el PUT fija también status para reactivarlo.
+    """
+    if upsert:
+        body = {key: value for key, value in contact.items() if key != "status" or restore}
+        body["status_if_new"] = contact["status"]
+        return {
+            "method": "PUT",
+            "path": f"/lists/{list_id}/members/{subscriber_hash(contact['email_address'])}",
+            "operation_id": str(position),
+            "body": json.dumps(body)
+        }
+    return {
+        "method": "POST",
+        "path": f"/lists/{list_id}/members",
+        "operation_id": str(position),
+        "body": json.dumps(contact)
+    }
+
+def _archive_operation(list_id, position, email):
+    """Operación de batch que archiva un contacto (DELETE por subscriber hash)."""
+    return {
+        "method": "DELETE",
+        "path": f"/lists/{list_id}/members/{subscriber_hash(email)}",
+        "operation_id": str(position)
+    }
+
+def _start_batch(client, label, operations, report, metrics=None):
+    """
+    Envía un bloque de operaciones (ver _member_operation) como batch de
+    Mailchimp, con reintentos.
+    Se ejecuta en un hilo del pool, por lo que no llama a st.*: los mensajes se
+    envían con report(nivel, mensaje) y se muestran desde el hilo principal.
+    Cada operación lleva como operation_id la posición del contacto en
+    contacts_data, para cruzar después los resultados del batch.
+    Devuelve el ID del batch, o None si no se pudo iniciar.
+    """
+    metrics = metrics or RunMetrics()
+    # Intentar cargar el bloque con reintentos
+    max_retries = 3
+    for retry_count in range(1, max_retries + 1):
+        try:
+            with metrics.span("batch_submit", items=len(operations)):
+                response = client.batches.start({"operations": operations})
+            report("info", f"{label}: batch started with ID: {response['id']}")
+            return response["id"]
+        except ApiClientError as error:
+            report("warning", f"{label} failed (attempt {retry_count}/{max_retries}): {error.text}")
+            if retry_count < max_retries:
+                metrics.count("batch_submit_retries")
+                report("info", f"Retrying {label} in 10 seconds...")
+                time.sleep(10)
+
+    report("error", f"{label} failed after {max_retries} attempts.")
+    return None
+
+class BatchWebhookReceiver:
+    """
+    Servidor HTTP local que recibe los webhooks de batch de Mailchimp.
+    Mailchimp hace un POST (form-encoded) con type=batch_operation_completed y
+    data[id], data[status]... al terminar cada batch.
+    Solo se aceptan peticiones con token en la query (ver webhook_url), y una
+    notificación solo despierta al tracker: el estado del batch se consulta
+    siempre a la API, nunca se toma del cuerpo recibido.
+    Un único receptor por proceso (get_batch_webhook_receiver) atiende a todas
+    las cargas en curso; cada BatchTracker recoge solo sus batches.
+    También se puede usar como context manager, p. ej. con un servidor de prueba.
+    """
+
+    def __init__(self, token, host="0.0.0.0", port=8502):
+        if not token:
+            raise ValueError("The batch webhook needs a token (mailchimp_batch_webhook_token in secrets.toml)")
+        self.token = token
+        self.host = host
+        self.port = port
+        self._completed = {}  # batch_id -> momento de la notificación
+        self._arrived = threading.Condition()
+        self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                # Mailchimp comprueba la URL con un GET antes de registrarla
+                self.send_response(200)
+                self.end_headers()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                token = parse_qs(urlsplit(self.path).query).get("token", [""])[0]
+                if not hmac.compare_digest(token.encode(), receiver.token.encode()):
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+                receiver._handle(self.headers.get("Content-Type", ""), body)
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handle(self, content_type, body):
+        if "json" in content_type:
+            payload = json.loads(body or b"{}")
+            data = payload.get("data", {})
+            event_type = payload.get("type")
+        else:
+            form = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+            data = {key[5:-1]: value for key, value in form.items() if key.startswith("data[")}
+            event_type = form.get("type")
+        if event_type == "batch_operation_completed" and data.get("id"):
+            with self._arrived:
+                # Mailchimp avisa de todos los batches de la cuenta: se olvidan los
+                # que ningún tracker ha recogido en MAILCHIMP_BATCH_WEBHOOK_RETENTION segundos
+                now = time.monotonic()
+                self._completed = {
+                    batch_id: received for batch_id, received in self._completed.items()
+                    if now - received < MAILCHIMP_BATCH_WEBHOOK_RETENTION
+                }
+                self._completed[data["id"]] = now
+                self._arrived.notify_all()
+
+    def pop_completed(self, batch_ids):
+        """Devuelve y olvida los IDs notificados de entre los batches indicados."""
+        with self._arrived:
+            notified = self._completed.keys() & set(batch_ids)
+            for batch_id in notified:
+                del self._completed[batch_id]
+            return notified
+
+    def wait(self, batch_ids, timeout):
+        """
+        Espera hasta timeout segundos o hasta que haya una notificación de
+        alguno de batch_ids, también si llegó antes de empezar a esperar.
+        """
+        batch_ids = set(batch_ids)
+        with self._arrived:
+            return bool(self._arrived.wait_for(lambda: self._completed.keys() & batch_ids, timeout))
+
+@functools.cache
+def get_batch_webhook_receiver():
+    """Registra el webhook de batch en Mailchimp y arranca el receptor del proceso."""
+    receiver = BatchWebhookReceiver(MAILCHIMP_BATCH_WEBHOOK_TOKEN, port=MAILCHIMP_BATCH_WEBHOOK_PORT)
+    ensure_batch_webhook(get_mailchimp_client(), MAILCHIMP_BATCH_WEBHOOK_URL, receiver.token)
+    return receiver.start()
+
+def webhook_url(url, token):
+    """URL del webhook con el token añadido a la query."""
+    return f"{url}{'&' if urlsplit(url).query else '?'}{urlencode({'token': token})}"
+
+def ensure_batch_webhook(client, url, token):
+    """
+    Registra url (con token) como webhook de batch en Mailchimp si no lo está
+    ya, y quita los registrados antes para la misma URL con otro token o sin él.
+    """
+    target = webhook_url(url, token)
+    registered = client.batchWebhooks.list().get("webhooks", [])
+    for webhook in registered:
+        if webhook.get("url") != target and webhook.get("url", "").split("?")[0] == url.split("?")[0]:
+            client.batchWebhooks.remove(webhook["id"])
+    if not any(webhook.get("url") == target for webhook in registered):
+        client.batchWebhooks.create({"url": target})
+
+class BatchTracker:
+    """
+    Sigue a la vez todos los batches enviados a Mailchimp.
+    Consulta el estado de todos los batches pendientes en cada ronda; el
+    intervalo entre rondas se duplica mientras nada cambia (hasta max_interval)
+    y vuelve a min_interval en cuanto algún batch avanza. Si hay un
+    BatchWebhookReceiver, sus notificaciones despiertan al tracker al momento
+    (el estado se consulta igualmente a la API).
+    on_done(key, batch_status) se llama al terminar cada batch, o con None si no
+    termina antes de timeout segundos desde que se añadió. run() termina cuando
+    se ha llamado a close() y no queda ningún batch pendiente; si falla por un
+    error inesperado, da por fallidos los batches pendientes y los que se
+    añadan después.
+    """
+
+    def __init__(self, client, on_done, report, min_interval=1.0, max_interval=30.0, timeout=3600, webhook=None, metrics=None):
+        self.client = client
+        self.metrics = metrics or RunMetrics()
+        self.on_done = on_done
+        self.report = report
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.webhook = webhook
+        self._outstanding = {}  # batch_id -> (key, label, última firma de progreso, límite)
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._crashed = False
+        self._stopped = False
+
+    def add(self, batch_id, key, label):
+        with self._lock:
+            if self._stopped:
+                return
+            if not self._crashed:
+                self._outstanding[batch_id] = (key, label, None, time.monotonic() + self.timeout)
+                return
+        self.report("error", f"{label}: batch tracking stopped, batch {batch_id} may still complete in Mailchimp.")
+        self.on_done(key, None)
+
+    def fail_outstanding(self):
+        """Da por fallidos todos los batches pendientes y los que se añadan después."""
+        with self._lock:
+            self._crashed = True
+            failed, self._outstanding = self._outstanding, {}
+        for batch_id, (key, label, _, _) in failed.items():
+            self.report("error", f"{label}: batch tracking stopped, batch {batch_id} may still complete in Mailchimp.")
+            self.on_done(key, None)
+
+    def close(self):
+        """Indica que no se añadirán más batches."""
+        self._closed.set()
+
+    def stop(self):
+        """Deja de seguir los batches pendientes sin llamar a on_done (la carga se ha interrumpido)."""
+        with self._lock:
+            self._stopped = True
+            self._outstanding = {}
+        self._closed.set()
+
+    def _sleep(self, interval):
+        if self.webhook:
+            with self._lock:
+                outstanding = list(self._outstanding)
+            self.webhook.wait(outstanding, interval)
+        else:
+            time.sleep(interval)
+
+    def run(self):
+        try:
+            self._poll()
+        except Exception as e:
+            logger.exception("Batch tracker failed")
+            self.report("error", f"Unexpected error tracking Mailchimp batches: {str(e)}")
+            self.fail_outstanding()
+
+    def _poll(self):
+        interval = self.min_interval
+        while True:
+            with self._lock:
+                outstanding = dict(self._outstanding)
+            if not outstanding:
+                if self._closed.is_set():
+                    return
+                self._sleep(self.min_interval)
+                continue
+
+            # Una notificación del webhook solo adelanta la consulta; el estado sale siempre de la API
+            notified = self.webhook.pop_completed(outstanding) if self.webhook else set()
+            if notified:
+                self.metrics.count("webhook_notifications", len(notified))
+            changed = False
+            for batch_id, (key, label, last_seen, deadline) in outstanding.items():
+                try:
+                    with self.metrics.span("batch_status"):
+                        batch_status = self.client.batches.status(batch_id)
+                    # Con un cuerpo vacío o que no es JSON el cliente devuelve la respuesta HTTP sin procesar
+                    if not isinstance(batch_status, dict):
+                        raise ValueError(f"unexpected response {batch_status!r}")
+                except ApiClientError as status_error:
+                    self.report("warning", f"{label}: error checking batch status: {status_error.text}")
+                    continue
+                except Exception as status_error:
+                    self.report("warning", f"{label}: error checking batch status: {str(status_error)}")
+                    continue
+
+                status = batch_status.get("status")
+                progress = (status, batch_status.get("finished_operations"))
+                if status == "finished":
+                    with self._lock:
+                        del self._outstanding[batch_id]
+                    self.on_done(key, batch_status)
+                    changed = True
+                elif progress != last_seen:
+                    with self._lock:
+                        self._outstanding[batch_id] = (key, label, progress, deadline)
+                    completed = batch_status.get("finished_operations", 0)
+                    total = batch_status.get("total_operations", 0)
+                    self.report("info", f"{label}: Status={status}, Progress={completed}/{total}")
+                    changed = True
+
+            # Cada batch caduca por separado, contando desde que se añadió
+            now = time.monotonic()
+            with self._lock:
+                expired = {batch_id: entry for batch_id, entry in self._outstanding.items() if now > entry[3]}
+                for batch_id in expired:
+                    del self._outstanding[batch_id]
+            for batch_id, (key, label, _, _) in expired.items():
+                self.report("error", f"{label} did not finish in {self.timeout} seconds (batch {batch_id} may still complete in Mailchimp).")
+                self.on_done(key, None)
+                changed = True
+
+            interval = self.min_interval if changed else min(interval * 2, self.max_interval)
+            with self.metrics.span("batch_wait"):
+                self._sleep(interval)
+
+def iter_batch_results(response_body_url, session=requests):
+    """
+    Recorre en streaming el tar.gz de resultados de un batch de Mailchimp.
+    El archivo contiene varios JSON, cada uno con una lista de operaciones; se
+    leen de uno en uno sin cargar el archivo completo en memoria.
+    Devuelve (operation_id, status_code, response) por cada operación.
+    """
+    with session.get(response_body_url, stream=True, timeout=120) as response:
+        response.raise_for_status()
+        with tarfile.open(fileobj=response.raw, mode="r|gz") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                for operation in json.load(archive.extractfile(member)):
+                    yield operation.get("operation_id"), operation.get("status_code"), operation.get("response")
+
+def _operation_error(response):
+    """Extrae un mensaje legible (p. ej. 'Member Exists') de la respuesta de una operación."""
+    try:
+        body = json.loads(response)
+        return body.get("title") or body.get("detail") or str(response)
+    except (TypeError, ValueError):
+        return str(response)
+
+def reconcile_batch(batch_status, session=requests):
+    """
+    Devuelve {operation_id: mensaje de error} con las operaciones fallidas de un
+    batch terminado. Si Mailchimp no informa errores no se descarga nada.
+    """
+    if not int(batch_status.get("errored_operations") or 0):
+        return {}
+    errors = {}
+    for operation_id, status_code, response in iter_batch_results(batch_status["response_body_url"], session):
+        if not status_code or int(status_code) >= 400:
+            errors[operation_id] = _operation_error(response)
+    return errors
+
+def batch_duration(batch_status):
+    """Segundos entre submitted_at y completed_at de un batch terminado, o None si no los informa."""
+    try:
+        submitted = datetime.fromisoformat(batch_status["submitted_at"])
+        completed = datetime.fromisoformat(batch_status["completed_at"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (completed - submitted).total_seconds()
+
+class BatchPlanner:
+    """
+    Decide cuántas operaciones lleva cada batch.
+    Los bloques se cortan hasta size operaciones sin que el payload serializado
+    pase de max_bytes. Con adaptive, size se ajusta con cada batch terminado:
+    se duplica si Mailchimp lo completó en menos de la mitad de target_seconds
+    y se reduce a la mitad si tardó más de target_seconds, no se pudo iniciar
+    o no terminó. Solo se usa desde el hilo principal de la carga.
+    """
+
+    def __init__(self, size=UPLOAD_CHUNK_SIZE, adaptive=True, min_size=BATCH_MIN_OPERATIONS,
+                 max_size=BATCH_MAX_OPERATIONS, max_bytes=BATCH_MAX_BYTES, target_seconds=BATCH_TARGET_SECONDS):
+        self.adaptive = adaptive
+        self.min_size = min(min_size, size)
+        self.max_size = max(max_size, size)
+        self.size = size
+        self.max_bytes = max_bytes
+        self.target_seconds = target_seconds
+
+    @staticmethod
+    def payload_sizes(operations):
+        """Bytes de cada operación dentro del cuerpo JSON del batch (incluido el separador)."""
+        return [len(json.dumps(operation)) + 2 for operation in operations]
+
+    def cut(self, sizes, start):
+        """Fin (exclusivo) del bloque que empieza en start; siempre lleva al menos una operación."""
+        end = start
+        total = len('{"operations": []}')
+        while end < len(sizes) and end - start < self.size and total + sizes[end] <= self.max_bytes:
+            total += sizes[end]
+            end += 1
+        return max(end, start + 1)
+
+    def observe(self, operations, seconds, ok=True):
+        """Ajusta size con el resultado de un batch de operations operaciones que tardó seconds."""
+        if not self.adaptive:
+            return
+        if not ok or seconds is None or seconds > self.target_seconds:
+            # Sin duración conocida solo se reduce si el batch falló
+            if not ok or seconds is not None:
+                self.size = max(self.min_size, self.size // 2)
+        elif seconds < self.target_seconds / 2 and operations >= self.size:
+            # Solo crece si el batch estaba lleno: uno pequeño no dice nada del límite
+            self.size = min(self.max_size, self.size * 2)
+
+def add_contacts_to_mailchimp(frames, lists, extra_fields_map=None, chunk_size=UPLOAD_CHUNK_SIZE, max_workers=MAILCHIMP_MAX_WORKERS, upsert=False, file_hash=None, on_event=None, adaptive=True, metrics=None, sync=False, archive_frames=None, max_in_flight=MAILCHIMP_MAX_BATCHES_IN_FLIGHT):
+    """
+    Sube los contactos de varias listas a Mailchimp en paralelo.
+    frames: diccionario list_name -> DataFrame con los contactos de esa lista
+    lists: diccionario list_name -> list_id de Mailchimp
+    Los bloques se cortan sobre la marcha con un BatchPlanner que empieza en
+    chunk_size contactos y, con adaptive, ajusta el tamaño según lo que tarda
+    Mailchimp en procesar cada batch. Hay como mucho max_in_flight batches en
+    curso a la vez, y las peticiones de todas las listas comparten un pool de
+    max_workers hilos.
+    upsert: enviar PUT por subscriber hash y omitir los contactos que el
+    SyncIndex local ya tiene sincronizados con los mismos merge fields.
+    sync: modo delta (implica upsert): cada lista se compara con su
+    ListSnapshot, descargada de nuevo de Mailchimp si ha caducado, en lugar
+    de con el SyncIndex; se envían solo altas y cambios, y se archivan los
+    contactos de archive_frames (list_name -> filas no activas del archivo)
+    que siguen suscritos.
+    file_hash: hash del archivo subido; si se indica, el progreso se guarda en
+    el JobJournal y una carga interrumpida del mismo archivo se reanuda.
+    on_event: callback que recibe el progreso como diccionarios:
+      {"type": "message", "level": "info" | "success" | "warning" | "error", "text": ...}
+      {"type": "progress", "done": {list_name: n}, "totals": {list_name: n}}
+      {"type": "table", "title": ..., "rows": [dict, ...], "expanded": bool opcional}
+    Siempre se llama desde el hilo que ejecuta esta función.
+    metrics: RunMetrics donde se miden las etapas de la carga.
+    """
+    on_event = on_event or log_event
+    metrics = metrics or RunMetrics()
+    notify = lambda level, text: on_event({"type": "message", "level": level, "text": text})
+    upsert = upsert or sync
+    client = get_mailchimp_client()
+    planner = BatchPlanner(chunk_size, adaptive)
+    results = {}
+    contacts_by_list = {}  # Para guardar en Google Sheets
+    chunks = []  # (list_name, chunk_idx, posiciones en contacts_data, operaciones, job_id, batch_id de una ejecución anterior)
+    pending = {}  # list_name -> contactos por cortar en bloques: posiciones, operaciones y su tamaño serializado
+    seen_emails = {}  # Email -> lista anterior que lo aceptó: cada dirección se envía a una sola lista
+    resumed_lists = set()
+    sync_index = snapshot = journal = writer = None
+    snapshot_members = {}  # list_name -> {subscriber_hash: (huella, estado)} en Mailchimp (modo sync)
+    # Todo lo que se abre se cierra en el finally, también si la carga falla a mitad:
+    # en el worker el proceso sigue vivo y los hilos y conexiones no se recuperarían
+    try:
+        sync_index = SyncIndex() if upsert else None
+        snapshot = ListSnapshot() if sync else None
+        journal = JobJournal() if file_hash else None
+
+        for list_name, list_id in lists.items():
+            df = frames.get(list_name)
+            inactive = (archive_frames or {}).get(list_name) if sync else None
+            has_inactive = inactive is not None and not inactive.empty
+            if df is None or (df.empty and not has_inactive):
+                results[list_name] = {"success": 0, "failed": 0, "skipped": 0, "duplicates": 0, "other_list": 0, "archived": 0}
+                continue
+
+            notify("info", f"Processing list: {list_name} (ID: {list_id}) with {len(df)} contacts...")
+
+            # Preparar todos los contactos
+            with metrics.span("payload_build", items=len(df)):
+                valid_contacts, valid_positions, contacts_data, invalid_rows = build_members(df, list_name, extra_fields_map, seen_emails)
+            duplicates = int((invalid_rows["reason"] == "duplicate").sum())
+            kept_elsewhere = invalid_rows.loc[invalid_rows["kept_in"] != "", "kept_in"].value_counts()
+            other_list = int(kept_elsewhere.sum())
+            if len(invalid_rows) > duplicates + other_list:
+                notify("warning", f"Skipping {len(invalid_rows) - duplicates - other_list} rows with invalid emails in {list_name}")
+            if duplicates:
+                notify("info", f"Skipping {duplicates} rows whose email already appears earlier in {list_name}")
+            if other_list:
+                notify("warning", f"Not adding {other_list} contacts to {list_name} because their email was already sent to another list: "
+                                  + ", ".join(f"{count} to {kept}" for kept, count in kept_elsewhere.items()))
+            if not invalid_rows.empty:
+                on_event({"type": "table", "title": f"Rejected rows ({list_name})", "rows": invalid_rows.to_dict("records")})
+
+            contacts_by_list[list_name] = contacts_data
+            results[list_name] = {"success": 0, "failed": len(invalid_rows) - duplicates - other_list, "skipped": 0,
+                                  "duplicates": duplicates, "other_list": other_list, "archived": 0}
+            member_by_position = dict(zip(valid_positions, valid_contacts))
+
+            archive_positions = []
+            if sync:
+                fields = sorted(field for field in (extra_fields_map or {}).get(list_name, {}) if field != 'email')
+                age = snapshot.age(list_id, fields)
+                if age is None or age > LIST_SNAPSHOT_MAX_AGE:
+                    try:
+                        start = time.perf_counter()
+                        entries = fetch_list_members(client, list_id, fields, max_workers)
+                        metrics.record("snapshot_fetch", time.perf_counter() - start, items=len(entries))
+                        snapshot.replace(list_id, fields, entries)
+                        age = 0
+                        notify("info", f"Downloaded {len(entries)} members of {list_name} from Mailchimp.")
+                    except (ApiClientError, requests.RequestException) as e:
+                        notify("warning", f"Could not download the members of {list_name} from Mailchimp ({getattr(e, 'text', e)})"
+                                          + (f"; using the copy from {age / 3600:.1f} hours ago." if age is not None
+                                             else "; comparing with the local index and archiving nothing."))
+                else:
+                    notify("info", f"Comparing {list_name} with the copy downloaded from Mailchimp {age / 60:.0f} minutes ago.")
+                if age is not None:
+                    snapshot_members[list_name] = snapshot.members(list_id)
+                    if has_inactive:
+                        # Los contactos por archivar se añaden al final de contacts_data, en el
+                        # orden del archivo, para que sus posiciones sirvan al reanudar
+                        active_emails = {contact['email_address'] for contact in contacts_data}
+                        for email in inactive_emails(inactive, list_name, extra_fields_map, active_emails):
+                            archive_positions.append(len(contacts_data))
+                            contacts_data.append({'email_address': email, 'merge_fields': {}, 'uploaded': False,
+                                                  'archive': True, 'sync_key': (subscriber_hash(email), None)})
+            archivable = set(archive_positions)
+            in_mailchimp = snapshot_members.get(list_name, {})
+
+            def operation(position):
+                contact = contacts_data[position]
+                if contact.get('archive'):
+                    return _archive_operation(list_id, position, contact['email_address'])
+                restore = in_mailchimp.get(subscriber_hash(contact['email_address']), (None, None))[1] == "archived"
+                return _member_operation(list_id, position, member_by_position[position], upsert, restore)
+
+            if not valid_contacts and not archive_positions:
+                notify("warning", f"No valid contacts found for {list_name}")
+                continue
+
+            job_id = journal.find_incomplete(file_hash, list_name) if journal else None
+            if job_id:
+                # Reanudar: los bloques ya cortados salen del diario; el resto se corta de nuevo
+                resumed_lists.add(list_name)
+                plan = journal.load_chunks(job_id)
+                completed = 0
+                for chunk_state in plan:
+                    # Un bloque cortado con otras reglas de validación puede incluir contactos que ahora se rechazan
+                    positions = [position for position in chunk_state["positions"]
+                                 if position in member_by_position or position in archivable]
+                    if upsert:
+                        for position in positions:
+                            if position in archivable:
+                                continue
+                            contacts_data[position]['sync_key'] = (
+                                subscriber_hash(contacts_data[position]['email_address']),
+                                member_fingerprint(member_by_position[position])
+                            )
+                    if chunk_state["status"] == "done":
+                        completed += 1
+                        for position in positions:
+                            if str(position) in chunk_state["errors"]:
+                                contacts_data[position]['error'] = chunk_state["errors"][str(position)]
+                                results[list_name]["failed"] += 1
+                            else:
+                                contacts_data[position]['uploaded'] = True
+                                results[list_name]["archived" if position in archivable else "success"] += 1
+                        continue
+                    chunks.append((
+                        list_name,
+                        chunk_state["chunk_idx"],
+                        positions,
+                        [operation(position) for position in positions],
+                        job_id,
+                        chunk_state["batch_id"]
+                    ))
+                notify("info", f"Resuming the previous upload of this file for {list_name}: {completed} of {len(plan)} chunks already completed.")
+                planned = {position for chunk_state in plan for position in chunk_state["positions"]}
+                unplanned = [(contact, position) for contact, position in zip(valid_contacts, valid_positions) if position not in planned]
+                valid_contacts = [contact for contact, _ in unplanned]
+                valid_positions = [position for _, position in unplanned]
+                archive_positions = [position for position in archive_positions if position not in planned]
+                next_chunk_idx = len(plan)
+            else:
+                next_chunk_idx = 0
+
+            if upsert:
+                # Omitir los contactos que ya están en Mailchimp con los mismos datos
+                if list_name in snapshot_members:
+                    synced = {hash_: fingerprint for hash_, (fingerprint, status) in in_mailchimp.items() if status != "archived"}
+                else:
+                    with metrics.span("sync_index_load"):
+                        synced = sync_index.fingerprints(list_id)
+                pending_contacts, pending_positions = [], []
+                for contact, position in zip(valid_contacts, valid_positions):
+                    sync_key = (subscriber_hash(contact["email_address"]), member_fingerprint(contact))
+                    contacts_data[position]['sync_key'] = sync_key
+                    if synced.get(sync_key[0]) == sync_key[1]:
+                        contacts_data[position]['uploaded'] = True
+                    else:
+                        pending_contacts.append(contact)
+                        pending_positions.append(position)
+                results[list_name]["skipped"] = len(valid_contacts) - len(pending_contacts)
+                valid_contacts, valid_positions = pending_contacts, pending_positions
+                if results[list_name]["skipped"]:
+                    notify("info", f"{list_name}: {results[list_name]['skipped']} contacts unchanged since the last upload, skipping them.")
+
+            if archive_positions:
+                # Solo se archivan los que siguen suscritos (o pendientes de confirmar) en Mailchimp
+                archive_positions = [
+                    position for position in archive_positions
+                    if in_mailchimp.get(contacts_data[position]['sync_key'][0], (None, None))[1] in ("subscribed", "pending")
+                ]
+                if archive_positions:
+                    notify("info", f"{list_name}: {len(archive_positions)} contacts are no longer active, archiving them in Mailchimp.")
+
+            if not valid_contacts and not archive_positions:
+                if job_id:
+                    journal.set_planned(job_id)
+                elif upsert:
+                    notify("success", f"No new or changed contacts for {list_name}")
+                continue
+
+            # Las operaciones se serializan una vez para medir el payload de cada bloque
+            positions = valid_positions + archive_positions
+            with metrics.span("payload_serialize", items=len(positions)):
+                operations = [operation(position) for position in positions]
+                sizes = BatchPlanner.payload_sizes(operations)
+            if journal and not job_id:
+                job_id = journal.create_job(file_hash, list_name, list_id)
+            pending[list_name] = {
+                "positions": positions,
+                "operations": operations,
+                "sizes": sizes,
+                "start": 0,
+                "chunk_idx": next_chunk_idx,
+                "job_id": job_id
+            }
+            notify("info", f"Sending {len(operations)} contacts for {list_name} in batches of about {planner.size} contacts"
+                           f"{', adjusted as Mailchimp responds' if adaptive else ''}...")
+
+        def next_chunk():
+            """Corta el siguiente bloque de contactos pendientes con el tamaño actual del planner; devuelve su clave o None."""
+            for list_name, state in pending.items():
+                if state["start"] == len(state["positions"]):
+                    continue
+                start, end = state["start"], planner.cut(state["sizes"], state["start"])
+                chunk_idx = state["chunk_idx"]
+                state["start"], state["chunk_idx"] = end, chunk_idx + 1
+                positions = state["positions"][start:end]
+                if journal:
+                    journal.add_chunk(state["job_id"], chunk_idx, positions, last=end == len(state["positions"]))
+                chunks.append((list_name, chunk_idx, positions, state["operations"][start:end], state["job_id"], None))
+                return len(chunks) - 1
+            return None
+
+        # Los hilos del pool no llaman a on_event; publican mensajes y bloques
+        # terminados en una cola que se atiende desde aquí
+        events = queue.Queue()
+        report = lambda level, message: events.put((level, message))
+
+        # Los resultados se escriben en Google Sheets a medida que terminan los bloques;
+        # los contactos que no se envían (inválidos o sin cambios) se escriben ya
+        if contacts_by_list:
+            try:
+                writer = SheetsWriter(list(contacts_by_list), report, metrics=metrics)
+            except Exception as e:
+                notify("error", f"❌ Google Sheets not available, results will not be saved: {str(e)}")
+        if writer:
+            to_send = {(list_name, position) for list_name, state in pending.items() for position in state["positions"]}
+            for list_name, contacts_data in contacts_by_list.items():
+                if list_name in resumed_lists:
+                    continue  # Ya se escribieron en la ejecución anterior
+                # Los duplicados no se escriben (su email ya tiene fila propia en la hoja de la lista), ni los
+                # contactos por archivar; los duplicados en otra lista sí, con ❌, para que conste que no se añadieron
+                writer.add(list_name, [
+                    sheet_row(contact) for position, contact in enumerate(contacts_data)
+                    if (list_name, position) not in to_send and not contact.get('duplicate') and not contact.get('archive')
+                ])
+
+        if chunks or pending:
+            totals = {}
+            for list_name, _, positions, _, _, _ in chunks:
+                totals[list_name] = totals.get(list_name, 0) + len(positions)
+            for list_name, state in pending.items():
+                totals[list_name] = totals.get(list_name, 0) + len(state["positions"])
+            done = {list_name: 0 for list_name in totals}
+            on_event({"type": "progress", "done": dict(done), "totals": totals})
+
+            def start_chunk(key):
+                list_name, chunk_idx, positions, operations, job_id, batch_id = chunks[key]
+                label = f"{list_name} chunk {chunk_idx + 1} ({len(positions)} contacts)"
+                # El bucle principal espera un evento "chunk" por bloque: si el batch no
+                # llega al tracker, el bloque se da por fallido pase lo que pase aquí
+                tracked = False
+                try:
+                    if batch_id:
+                        # Batch enviado en una ejecución anterior: seguirlo en vez de reenviarlo
+                        try:
+                            client.batches.status(batch_id)
+                            report("info", f"{label}: re-attached to batch {batch_id}")
+                            tracker.add(batch_id, key, label)
+                            tracked = True
+                            return
+                        except ApiClientError as error:
+                            report("warning", f"{label}: previous batch {batch_id} not available ({error.text}), resubmitting.")
+                    batch_id = _start_batch(client, label, operations, report, metrics)
+                    if batch_id:
+                        tracker.add(batch_id, key, label)
+                        tracked = True
+                        if journal:
+                            journal.set_batch(job_id, chunk_idx, batch_id)
+                    elif journal:
+                        journal.finish_chunk(job_id, chunk_idx, "failed")
+                except Exception as e:
+                    report("error", f"Unexpected error uploading {label}: {str(e)}")
+                finally:
+                    if not tracked:
+                        events.put(("chunk", key, None, None))
+
+            def finish_chunk(key, batch_status):
+                # Descargar los resultados por operación fuera del hilo del tracker;
+                # el evento "chunk" se publica siempre, sin errores (None) si algo falla
+                list_name, chunk_idx, _, _, _, _ = chunks[key]
+                errors = seconds = None
+                try:
+                    if batch_status is not None:
+                        try:
+                            with metrics.span("batch_results", items=int(batch_status.get("errored_operations") or 0)):
+                                found = reconcile_batch(batch_status, session)
+                        except (requests.RequestException, tarfile.TarError, ValueError) as e:
+                            errored = int(batch_status.get("errored_operations") or 0)
+                            if errored:
+                                # Sin los resultados no se sabe qué contactos fallaron: el bloque queda
+                                # sin cerrar en el diario y al reanudar se vuelven a descargar
+                                report("error", f"{list_name} chunk {chunk_idx + 1}: could not read batch results ({str(e)}) "
+                                                f"and {errored} operations reported errors; the chunk will be checked again "
+                                                f"when the upload is resumed.")
+                                return
+                            report("warning", f"{list_name} chunk {chunk_idx + 1}: could not read batch results ({str(e)}); "
+                                              f"Mailchimp reported no errors.")
+                            found = {}
+                        seconds = batch_duration(batch_status)
+                        errors = found
+                except Exception as e:
+                    report("error", f"{list_name} chunk {chunk_idx + 1}: unexpected error reading batch results: {str(e)}")
+                finally:
+                    events.put(("chunk", key, errors, seconds))
+
+            session = get_http_session()
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                webhook = None
+                if MAILCHIMP_BATCH_WEBHOOK_URL:
+                    try:
+                        webhook = get_batch_webhook_receiver()
+                    except (ApiClientError, OSError, ValueError) as e:
+                        notify("warning", f"Batch webhook not available, polling only: {getattr(e, 'text', e)}")
+
+                tracker = BatchTracker(
+                    client,
+                    on_done=lambda key, batch_status: pool.submit(finish_chunk, key, batch_status),
+                    report=report,
+                    # Con webhook el sondeo solo es una red de seguridad
+                    max_interval=120.0 if webhook else 30.0,
+                    timeout=BATCH_TIMEOUT,
+                    webhook=webhook,
+                    metrics=metrics
+                )
+                tracker_thread = threading.Thread(target=tracker.run, daemon=True)
+                tracker_thread.start()
+
+                # Como mucho max_in_flight batches en curso: cada bloque nuevo se corta
+                # cuando termina otro, con el tamaño que decide el planner en ese momento
+                resumed = list(range(len(chunks)))
+                started_at = {}
+
+                def submit_next():
+                    key = resumed.pop(0) if resumed else next_chunk()
+                    if key is None:
+                        return False
+                    started_at[key] = time.monotonic()
+                    pool.submit(start_chunk, key)
+                    return True
+
+                try:
+                    in_flight = 0
+                    while in_flight < max_in_flight and submit_next():
+                        in_flight += 1
+                    while in_flight:
+                        try:
+                            event = events.get(timeout=5)
+                        except queue.Empty:
+                            # Si el hilo del tracker ya no existe, nadie terminará sus batches
+                            if not tracker_thread.is_alive():
+                                tracker.fail_outstanding()
+                            continue
+                        if event[0] != "chunk":
+                            notify(*event)
+                            continue
+                        _, key, errors, seconds = event
+                        in_flight -= 1
+                        list_name, chunk_idx, positions, _, job_id, _ = chunks[key]
+                        # Si Mailchimp no informa la duración del batch se usa la medida localmente
+                        seconds = seconds if seconds is not None else time.monotonic() - started_at[key]
+                        planner.observe(len(positions), seconds, ok=errors is not None)
+                        metrics.count("batches")
+                        if errors is None:
+                            metrics.count("batches_failed")
+                        else:
+                            # Tiempo de proceso en Mailchimp, desde que se envía hasta que termina
+                            metrics.record("batch_processing", seconds, items=len(positions))
+                        if errors is None:
+                            results[list_name]["failed"] += len(positions)
+                        else:
+                            # Marcar cada contacto según el resultado de su operación
+                            for position in positions:
+                                contact = contacts_by_list[list_name][position]
+                                if str(position) in errors:
+                                    contact['error'] = errors[str(position)]
+                                else:
+                                    contact['uploaded'] = True
+                            failed = sum(str(position) in errors for position in positions)
+                            succeeded = [contacts_by_list[list_name][position] for position in positions if str(position) not in errors]
+                            archived = sum(bool(contact.get('archive')) for contact in succeeded)
+                            results[list_name]["success"] += len(succeeded) - archived
+                            results[list_name]["archived"] += archived
+                            results[list_name]["failed"] += failed
+                            if journal:
+                                journal.finish_chunk(job_id, chunk_idx, "done", errors)
+                            if sync_index:
+                                sync_index.mark_synced(lists[list_name], [
+                                    contact['sync_key'] for contact in succeeded if not contact.get('archive')
+                                ])
+                                sync_index.forget(lists[list_name], [
+                                    contact['sync_key'][0] for contact in succeeded if contact.get('archive')
+                                ])
+                            if list_name in snapshot_members:
+                                snapshot.update(lists[list_name], [
+                                    snapshot_entry(snapshot_members[list_name], contact) for contact in succeeded
+                                ])
+                            message = (f"{list_name} chunk {chunk_idx + 1} completed. {len(succeeded) - archived} contacts uploaded, "
+                                       f"{f'{archived} archived, ' if archived else ''}{failed} failed.")
+                            notify("warning" if failed else "success", message)
+                        if writer:
+                            writer.add(list_name, [
+                                sheet_row(contacts_by_list[list_name][position]) for position in positions
+                                if not contacts_by_list[list_name][position].get('archive')
+                            ])
+                        done[list_name] += len(positions)
+                        on_event({"type": "progress", "done": dict(done), "totals": totals})
+                        while in_flight < max_in_flight and submit_next():
+                            in_flight += 1
+                finally:
+                    # Si la carga se interrumpe, el tracker deja de seguir sus batches
+                    tracker.stop()
+
+        if writer:
+            notify("info", "Saving remaining results to Google Sheets...")
+            with metrics.span("sheets_flush"):
+                writer.close()
+        while not events.empty():
+            notify(*events.get())
+
+        for list_name in {chunk[0]: None for chunk in chunks}:
+            success, failed, archived = results[list_name]["success"], results[list_name]["failed"], results[list_name]["archived"]
+            notify("success", f"Bulk upload completed for {list_name}. Total: {success} successful, "
+                              f"{f'{archived} archived, ' if archived else ''}{failed} failed.")
+            error_counts = pd.Series([c['error'] for c in contacts_by_list[list_name] if 'error' in c], dtype=object).value_counts()
+            if not error_counts.empty:
+                on_event({
+                    "type": "table",
+                    "title": f"Mailchimp errors ({list_name})",
+                    "rows": error_counts.rename_axis("error").reset_index(name="contacts").to_dict("records")
+                })
+        if chunks:
+            notify("info", f"{len(chunks)} batches sent to Mailchimp; batch size ended at {planner.size} contacts.")
+
+        if writer:
+            for list_name in contacts_by_list:
+                if writer.saved[list_name]:
+                    notify("success", f"✅ {writer.saved[list_name]} records saved to Google Sheets ({list_name})")
+                if writer.unsaved[list_name]:
+                    notify("error", f"❌ {writer.unsaved[list_name]} records could not be saved to Google Sheets ({list_name})")
+
+        return results
+    finally:
+        if writer:
+            # Escribe lo que quede pendiente; si ya estaba cerrado no hace nada
+            writer.close()
+        if sync_index:
+            sync_index.close()
+        if snapshot:
+            snapshot.close()
+        if journal:
+            journal.close()
+
+def snapshot_entry(members, contact):
+    """
+    Fila de ListSnapshot para un contacto subido correctamente: los archivados
+    conservan su huella; los demás quedan con la suya y su estado en Mailchimp
+    (suscritos si eran nuevos o estaban archivados).
+    """
+    hash_, fingerprint = contact['sync_key']
+    previous_fingerprint, status = members.get(hash_, (None, None))
+    if contact.get('archive'):
+        return hash_, previous_fingerprint or "", "archived"
+    return hash_, fingerprint, status if status not in (None, "archived") else "subscribed"
+
+def log_event(event):
+    """on_event por defecto: envía los mensajes al log."""
+    if event["type"] == "message":
+        level = {"warning": logging.WARNING, "error": logging.ERROR}.get(event["level"], logging.INFO)
+        logger.log(level, event["text"])
+
+def file_sha256(path):
+    """Hash del contenido de un archivo, leído por bloques."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def upload_file(path, upsert=True, chunk_size=UPLOAD_CHUNK_SIZE, max_workers=MAILCHIMP_MAX_WORKERS, on_event=None, adaptive=True, metrics=None, sync=False, max_in_flight=MAILCHIMP_MAX_BATCHES_IN_FLIGHT):
+    """
+    Carga completa de un archivo xlsx o csv: lectura, asignación a listas y subida.
+    Un archivo interrumpido se reanuda en la siguiente llamada (ver JobJournal).
+    sync: modo delta contra Mailchimp; los contactos no activos se archivan
+    (ver add_contacts_to_mailchimp).
+    Al terminar, también si falla, envía el resumen de tiempos de metrics.
+    """
+    on_event = on_event or log_event
+    metrics = metrics or RunMetrics()
+    try:
+        with open(path, "rb") as f:
+            df, has_status = read_contacts(f, metrics=metrics, keep_inactive=sync)
+        if not has_status:
+            raise ValueError("Column 'L' does not exist in the uploaded file. The file must have at least 12 columns.")
+        archive_frames = None
+        if sync:
+            active = is_active(df)
+            archive_frames = group_by_list(df[~active])
+            df = df[active]
+        frames = group_by_list(df)
+        on_event({
+            "type": "message",
+            "level": "info",
+            "text": " | ".join(f"{list_name}: {len(frame)} leads" for list_name, frame in frames.items())
+        })
+        with metrics.span("file_hash"):
+            file_hash = file_sha256(path)
+        return add_contacts_to_mailchimp(frames, LISTS, EXTRA_FIELDS_MAP, chunk_size, max_workers, upsert=upsert,
+                                         file_hash=file_hash, on_event=on_event, adaptive=adaptive, metrics=metrics,
+                                         sync=sync, archive_frames=archive_frames, max_in_flight=max_in_flight)
+    finally:
+        metrics.report(on_event)
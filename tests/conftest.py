@@ -0,0 +1,37 @@
+import pytest
+
+import bench  # antes que engine: define los secrets obligatorios
+import engine
+from bench.fakes import FakeMailchimpServer, FakeSpreadsheet
+from bench.generate import generate_contacts, write_contacts
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Directorio temporal de trabajo: el SyncIndex, el JobJournal y la ListSnapshot se crean aquí."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def spreadsheet(monkeypatch):
+    """FakeSpreadsheet en lugar de Google Sheets."""
+    spreadsheet = FakeSpreadsheet()
+    monkeypatch.setattr(engine, "get_spreadsheet", lambda: spreadsheet)
+    monkeypatch.setattr(engine, "get_worksheet", spreadsheet.worksheet)
+    return spreadsheet
+
+@pytest.fixture
+def mailchimp(monkeypatch, spreadsheet, workdir):
+    """FakeMailchimpServer en lugar de Mailchimp (y FakeSpreadsheet en lugar de Google Sheets)."""
+    with FakeMailchimpServer(batch_seconds=0.1) as server:
+        client = server.mailchimp_client(engine.get_http_session())
+        monkeypatch.setattr(engine, "get_mailchimp_client", lambda: client)
+        yield server
+
+@pytest.fixture
+def contacts_file(workdir):
+    """Crea un csv de contactos sintéticos; devuelve su ruta."""
+    def make(rows, seed=0, name="contacts.csv", **options):
+        path = str(workdir / name)
+        write_contacts(generate_contacts(rows, seed, **options), path)
+        return path
+    return make
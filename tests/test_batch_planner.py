@@ -0,0 +1,52 @@
+import engine
+
+def planner(size=4, **options):
+    return engine.BatchPlanner(size, min_size=2, max_size=16, **options)
+
+def test_cut_respects_size_and_byte_cap():
+    sizes = [10] * 10
+    assert planner(4).cut(sizes, 0) == 4
+    assert planner(4).cut(sizes, 8) == 10
+    # El cuerpo vacío ocupa 18 bytes: caben 3 operaciones de 10 en 50
+    assert planner(8, max_bytes=50).cut(sizes, 0) == 3
+
+def test_cut_takes_at_least_one_operation():
+    assert planner(4, max_bytes=50).cut([100, 10], 0) == 1
+
+def test_grows_only_when_the_batch_was_full():
+    batches = planner(4, target_seconds=100)
+    batches.observe(3, 10)
+    assert batches.size == 4
+    batches.observe(4, 10)
+    assert batches.size == 8
+    # Sin duración conocida no cambia
+    batches.observe(8, None)
+    assert batches.size == 8
+
+def test_shrinks_on_failure_or_slow_batch():
+    batches = planner(8, target_seconds=100)
+    batches.observe(8, None, ok=False)
+    assert batches.size == 4
+    batches.observe(4, 150)
+    assert batches.size == 2
+    batches.observe(2, 150)
+    assert batches.size == 2
+
+def test_fixed_size_is_not_adjusted():
+    batches = planner(4, adaptive=False)
+    batches.observe(4, 1)
+    batches.observe(4, None, ok=False)
+    assert batches.size == 4
+
+def test_in_flight_window_is_independent_of_http_workers(mailchimp, contacts_file, monkeypatch):
+    pending = []
+    add = engine.BatchTracker.add
+    def record(self, *args):
+        add(self, *args)
+        pending.append(len(self._outstanding))
+    monkeypatch.setattr(engine.BatchTracker, "add", record)
+    mailchimp.batch_seconds = 1
+    engine.upload_file(contacts_file(1000), upsert=False, chunk_size=100, adaptive=False, max_workers=1,
+                       max_in_flight=4, on_event=lambda event: None)
+    assert max(pending) > 1
+    assert max(pending) <= 4
@@ -0,0 +1,57 @@
+import threading
+
+import engine
+
+def run_with_limit(target, seconds):
+    """Ejecuta target en un hilo; devuelve su resultado o falla si no termina en seconds segundos."""
+    outcome = {}
+    thread = threading.Thread(target=lambda: outcome.setdefault("result", target()), daemon=True)
+    thread.start()
+    thread.join(seconds)
+    assert not thread.is_alive(), f"did not finish in {seconds} seconds"
+    return outcome["result"]
+
+def test_run_longer_than_batch_timeout_finishes(mailchimp, contacts_file, monkeypatch):
+    # El plazo es por batch: una carga que dura más que BATCH_TIMEOUT no se queda esperando
+    monkeypatch.setattr(engine, "BATCH_TIMEOUT", 3)
+    path = contacts_file(3000)
+    results = run_with_limit(lambda: engine.upload_file(
+        path, upsert=False, chunk_size=100, max_workers=1, on_event=lambda event: None, adaptive=False
+    ), 120)
+    assert mailchimp.requests["start"] > 5
+    assert sum(res["success"] for res in results.values()) > 0
+
+def test_batch_that_does_not_finish_expires(mailchimp, contacts_file, monkeypatch):
+    monkeypatch.setattr(engine, "BATCH_TIMEOUT", 2)
+    mailchimp.batch_seconds = 60
+    path = contacts_file(300)
+    results = run_with_limit(lambda: engine.upload_file(
+        path, upsert=False, on_event=lambda event: None
+    ), 60)
+    assert all(res["success"] == 0 for res in results.values())
+    assert sum(res["failed"] for res in results.values()) > 0
+
+def test_unexpected_status_error_is_retried(mailchimp, contacts_file, monkeypatch):
+    client = engine.get_mailchimp_client()
+    status = client.batches.status
+    calls = []
+    def flaky(batch_id):
+        calls.append(batch_id)
+        if len(calls) == 1:
+            raise ValueError("boom")
+        return status(batch_id)
+    monkeypatch.setattr(client.batches, "status", flaky)
+    results = run_with_limit(lambda: engine.upload_file(
+        contacts_file(300), upsert=False, on_event=lambda event: None
+    ), 60)
+    assert sum(res["success"] for res in results.values()) > 0
+
+def test_tracker_crash_fails_outstanding_batches(mailchimp, contacts_file, monkeypatch):
+    def crash(self):
+        raise RuntimeError("tracker bug")
+    monkeypatch.setattr(engine.BatchTracker, "_poll", crash)
+    results = run_with_limit(lambda: engine.upload_file(
+        contacts_file(300), upsert=False, on_event=lambda event: None
+    ), 60)
+    assert all(res["success"] == 0 for res in results.values())
+    assert sum(res["failed"] for res in results.values()) > 0
@@ -0,0 +1,16 @@
+import engine
+from bench.generate import generate_contacts, write_contacts
+
+def test_xlsx_and_csv_read_back_the_same(workdir):
+    df = generate_contacts(2000, seed=3)
+    frames = {}
+    for extension in ("csv", "xlsx"):
+        path = str(workdir / f"contacts.{extension}")
+        write_contacts(df, path)
+        with open(path, "rb") as f:
+            frames[extension], _ = engine.read_contacts(f)
+    csv, xlsx = (frames[extension].reset_index(drop=True) for extension in ("csv", "xlsx"))
+    assert len(csv) == len(xlsx)
+    assert (csv["list"] == xlsx["list"]).all()
+    assert csv["C"].fillna("").tolist() == xlsx["C"].fillna("").tolist()
+    assert not xlsx["B"].astype(str).str.startswith('="').any()
@@ -0,0 +1,28 @@
+import pandas as pd
+
+import engine
+
+def frame(emails):
+    return pd.DataFrame({"C": emails, "D": "Ana", "E": "Lopez", "F": "1 Main St", "J": "07030", "K": "2015550100"})
+
+def test_cross_list_duplicates_name_the_list_that_kept_them():
+    seen = {}
+    engine.build_members(frame(["a@gmail.com", "b@gmail.com"]), "Bravo NY", engine.EXTRA_FIELDS_MAP, seen)
+    members, positions, contacts, invalid = engine.build_members(
+        frame(["A@gmail.com ", "c@gmail.com", "c@gmail.com"]), "CTown", engine.EXTRA_FIELDS_MAP, seen
+    )
+    assert [member["email_address"] for member in members] == ["c@gmail.com"]
+    assert invalid["reason"].tolist() == ["duplicate in another list", "duplicate"]
+    assert invalid["kept_in"].tolist() == ["Bravo NY", ""]
+    assert contacts[0]["kept_in"] == "Bravo NY" and not contacts[0].get("duplicate")
+    assert contacts[2]["duplicate"]
+    assert seen == {"a@gmail.com": "Bravo NY", "b@gmail.com": "Bravo NY", "c@gmail.com": "CTown"}
+
+def test_cross_list_duplicates_are_reported_and_written_to_the_sheet(mailchimp, spreadsheet):
+    frames = {"Bravo NY": frame(["a@gmail.com"]), "CTown": frame(["a@gmail.com", "b@gmail.com"])}
+    events = []
+    results = engine.add_contacts_to_mailchimp(frames, engine.LISTS, engine.EXTRA_FIELDS_MAP, on_event=events.append)
+    assert results["CTown"]["other_list"] == 1 and results["CTown"]["failed"] == 0
+    assert any("1 to Bravo NY" in event.get("text", "") for event in events)
+    rows = spreadsheet.worksheet(engine.SHEET_NAMES["CTown"]).rows
+    assert ["a@gmail.com", "Ana", "2015550100", "❌"] in rows
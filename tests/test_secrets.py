@@ -0,0 +1,16 @@
+import pytest
+
+import engine
+
+def test_secret_reads_environment_under_both_names(monkeypatch):
+    monkeypatch.setenv("krasdale_test_secret", "streamlit")
+    assert engine.secret("krasdale_test_secret") == "streamlit"
+    monkeypatch.setenv("KRASDALE_TEST_SECRET", "upper")
+    assert engine.secret("krasdale_test_secret") == "upper"
+
+def test_missing_required_secret_raises(monkeypatch):
+    monkeypatch.delenv("KRASDALE_TEST_SECRET", raising=False)
+    monkeypatch.delenv("krasdale_test_secret", raising=False)
+    assert engine.secret("krasdale_test_secret", "default", required=True) == "default"
+    with pytest.raises(KeyError, match="krasdale_test_secret"):
+        engine.secret("krasdale_test_secret", required=True)
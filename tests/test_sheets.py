@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+import engine
+
+def test_concurrent_writers_append_without_overwriting(spreadsheet):
+    writers = [engine.SheetsWriter(["CTown"], lambda level, message: None, flush_interval=0.05) for _ in range(2)]
+    for idx, writer in enumerate(writers):
+        writer.add("CTown", [[f"user{idx}-{n}@example.org", "", "", "✅"] for n in range(50)])
+    writers[1].add("CTown", [["", "", "", "❌"]])
+    for writer in writers:
+        writer.close()
+    rows = spreadsheet.worksheet(engine.SHEET_NAMES["CTown"]).rows
+    assert len(rows) == 101
+    assert sum(row[0] == "" for row in rows) == 1
+    assert [writer.saved["CTown"] for writer in writers] == [50, 51]
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    sleep = time.sleep
+    monkeypatch.setattr(engine.time, "sleep", lambda seconds: sleep(min(seconds, 0.01)))
+
+def rows(n):
+    return [[f"user{n}@example.org", "", "", "✅"] for n in range(n)]
+
+def test_failed_write_is_retried(spreadsheet, no_backoff, monkeypatch):
+    batch_update = spreadsheet.batch_update
+    calls = []
+    def flaky(body):
+        calls.append(body)
+        if len(calls) == 1:
+            raise RuntimeError("Simulated Google Sheets error")
+        return batch_update(body)
+    monkeypatch.setattr(spreadsheet, "batch_update", flaky)
+    messages = []
+    writer = engine.SheetsWriter(["CTown"], lambda level, message: messages.append(level), flush_interval=0.05)
+    writer.add("CTown", rows(10))
+    writer.close()
+    assert len(calls) == 2
+    assert messages == ["warning"]
+    assert spreadsheet.worksheet(engine.SHEET_NAMES["CTown"]).rows == rows(10)
+    assert writer.saved["CTown"] == 10 and writer.unsaved["CTown"] == 0
+
+def test_rows_that_keep_failing_are_counted_as_unsaved(spreadsheet, no_backoff):
+    spreadsheet.failure_rate = 1.0
+    messages = []
+    writer = engine.SheetsWriter(["CTown", "Bravo NY"], lambda level, message: messages.append(level),
+                                 flush_interval=0.05, max_cells=40)
+    writer.add("CTown", rows(15))
+    writer.add("Bravo NY", rows(5))
+    writer.close()
+    assert writer.unsaved == {"CTown": 15, "Bravo NY": 5}
+    assert writer.saved == {"CTown": 0, "Bravo NY": 0}
+    # Dos lotes de 10 filas, cada uno con tres intentos
+    assert spreadsheet.requests == 6
+    assert messages.count("error") == 2
+
+def test_writes_are_split_at_max_cells(spreadsheet):
+    writer = engine.SheetsWriter(["CTown"], lambda level, message: None, flush_interval=0.05, max_cells=8)
+    writer.add("CTown", rows(5))
+    writer.close()
+    assert spreadsheet.requests == 3
+    assert spreadsheet.worksheet(engine.SHEET_NAMES["CTown"]).rows == rows(5)
@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+import engine
+from bench.generate import generate_contacts, write_contacts
+from tests.test_batch_tracker import run_with_limit
+
+@pytest.fixture
+def sync_upload(workdir):
+    """Escribe df en un csv nuevo y lo sube en modo sync; devuelve los resultados y los mensajes."""
+    uploads = []
+    def run(df):
+        path = str(workdir / f"contacts{len(uploads)}.csv")
+        write_contacts(df, path)
+        messages = []
+        results = run_with_limit(lambda: engine.upload_file(
+            path, sync=True, on_event=lambda event: messages.append(event.get("text", ""))
+        ), 120)
+        uploads.append(path)
+        return results, messages
+    return run
+
+def inactive(df):
+    df = df.copy()
+    df[11] = "inactive"
+    return df
+
+def statuses(mailchimp):
+    return {hash_: status for members in mailchimp.members.values() for hash_, (_, status) in members.items()}
+
+def total(results, key):
+    return sum(res[key] for res in results.values())
+
+def test_inactive_rows_archive_only_subscribed_members(mailchimp, sync_upload, monkeypatch):
+    df = generate_contacts(600, 3)
+    sync_upload(df)
+    before = statuses(mailchimp)
+    assert set(before.values()) == {"subscribed"}
+    # Alguien se da de baja en Mailchimp: no se archiva
+    list_id, members = next(iter(mailchimp.members.items()))
+    unsubscribed, (merge_fields, _) = next(iter(members.items()))
+    members[unsubscribed] = (merge_fields, "unsubscribed")
+    monkeypatch.setattr(engine, "LIST_SNAPSHOT_MAX_AGE", 0)
+
+    results, _ = sync_upload(inactive(df))
+    after = statuses(mailchimp)
+    assert after.keys() == before.keys()
+    assert after[unsubscribed] == "unsubscribed"
+    assert all(status == "archived" for hash_, status in after.items() if hash_ != unsubscribed)
+    assert total(results, "archived") == len(before) - 1
+    assert total(results, "success") == 0
+
+def test_archived_members_are_reactivated(mailchimp, sync_upload):
+    df = generate_contacts(600, 4)
+    sync_upload(df)
+    sync_upload(inactive(df))
+    assert set(statuses(mailchimp).values()) == {"archived"}
+
+    results, _ = sync_upload(df)
+    assert set(statuses(mailchimp).values()) == {"subscribed"}
+    assert total(results, "success") == len(statuses(mailchimp))
+
+def test_unchanged_members_are_skipped(mailchimp, sync_upload):
+    df = generate_contacts(600, 5)
+    first, _ = sync_upload(df)
+    started = mailchimp.requests["start"]
+    df.loc[df.index[:50], 3] = "Changed"
+    second, _ = sync_upload(df)
+    changed = sum(merge_fields["FNAME"] == "Changed" for members in mailchimp.members.values()
+                  for merge_fields, _ in members.values())
+    assert 0 < total(second, "success") == changed
+    assert total(second, "skipped") == total(first, "success") - changed
+    assert mailchimp.requests["start"] - started <= len(engine.LISTS)
+
+def test_archive_is_resumed_after_a_failed_run(mailchimp, sync_upload, monkeypatch):
+    sleep = time.sleep
+    monkeypatch.setattr(engine.time, "sleep", lambda seconds: sleep(min(seconds, 0.05)))
+    df = generate_contacts(600, 6)
+    sync_upload(df)
+    subscribed = len(statuses(mailchimp))
+    rows = inactive(df)
+
+    mailchimp.start_failure_rate = 1.0
+    failed, _ = sync_upload(rows)
+    assert total(failed, "archived") == 0
+    assert set(statuses(mailchimp).values()) == {"subscribed"}
+
+    mailchimp.start_failure_rate = 0.0
+    resumed, messages = sync_upload(rows)
+    assert any(message.startswith("Resuming") for message in messages)
+    assert total(resumed, "archived") == subscribed
+    assert set(statuses(mailchimp).values()) == {"archived"}
+
+def test_merge_values_are_normalized_before_fingerprinting():
+    local = {"merge_fields": {"ADDRESS": "1 Main St", "PHONE": "2015550100", "FNAME": "Ana "}}
+    fetched = {"merge_fields": {
+        "ADDRESS": {"addr1": "1 Main St", "addr2": "", "city": "", "state": "", "zip": "", "country": "US"},
+        "PHONE": "(201) 555-0100",
+        "FNAME": "Ana"
+    }}
+    assert engine.member_fingerprint(local) == engine.member_fingerprint(fetched)
+    assert engine.member_fingerprint(local) != engine.member_fingerprint({"merge_fields": {**local["merge_fields"], "FNAME": "Eva"}})
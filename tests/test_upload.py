@@ -0,0 +1,68 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import engine
+from tests.test_batch_tracker import run_with_limit
+
+def upload(path, **options):
+    return run_with_limit(lambda: engine.upload_file(path, on_event=lambda event: None, **options), 120)
+
+def test_unexpected_error_reading_results_fails_the_chunk(mailchimp, contacts_file, monkeypatch):
+    def broken(batch_status, session=None):
+        raise KeyError("response_body_url")
+    monkeypatch.setattr(engine, "reconcile_batch", broken)
+    results = upload(contacts_file(500), upsert=False)
+    assert all(res["success"] == 0 for res in results.values())
+
+def test_unexpected_error_recording_the_batch_does_not_hang(mailchimp, contacts_file, monkeypatch):
+    def locked(*args):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(engine.JobJournal, "set_batch", locked)
+    results = upload(contacts_file(500), upsert=False)
+    assert sum(res["success"] for res in results.values()) > 0
+
+def test_unreadable_results_with_errors_are_not_marked_synced(mailchimp, contacts_file, monkeypatch):
+    mailchimp.operation_error_rate = 0.1
+    path = contacts_file(500)
+    def unreachable(response_body_url, session=None):
+        raise engine.requests.ConnectionError("results not available")
+    with monkeypatch.context() as patch:
+        patch.setattr(engine, "iter_batch_results", unreachable)
+        results = upload(path, upsert=True)
+    assert all(res["success"] == 0 for res in results.values())
+    index = engine.SyncIndex()
+    assert not any(index.fingerprints(list_id) for list_id in engine.LISTS.values())
+    index.close()
+
+    # Al reanudar se siguen los mismos batches y se leen sus resultados
+    starts = mailchimp.requests["start"]
+    results = upload(path, upsert=True)
+    assert mailchimp.requests["start"] == starts
+    assert sum(res["success"] for res in results.values()) > 0
+    assert sum(res["failed"] for res in results.values()) > 0
+
+def test_failed_run_closes_the_sheets_writer_and_the_tracker(mailchimp, spreadsheet, contacts_file, monkeypatch):
+    def locked(*args):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(engine.JobJournal, "finish_chunk", locked)
+    trackers = []
+    original = engine.BatchTracker.__init__
+    def remember(self, *args, **kwargs):
+        original(self, *args, **kwargs)
+        trackers.append(self)
+    monkeypatch.setattr(engine.BatchTracker, "__init__", remember)
+    threads = threading.active_count()
+    path = contacts_file(500)
+    def failing_upload():
+        with pytest.raises(sqlite3.OperationalError):
+            engine.upload_file(path, upsert=False, on_event=lambda event: None)
+        return True
+    assert run_with_limit(failing_upload, 120)
+    # Las filas ya encoladas se escriben y los hilos terminan
+    assert spreadsheet.rows_written > 0
+    assert trackers and trackers[0]._stopped
+    time.sleep(2)
+    assert threading.active_count() <= threads
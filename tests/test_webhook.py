@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+import requests
+
+import engine
+
+@pytest.fixture
+def receiver():
+    with engine.BatchWebhookReceiver("s3cret", host="127.0.0.1", port=0) as receiver:
+        receiver.url = f"http://127.0.0.1:{receiver._server.server_address[1]}/"
+        yield receiver
+
+def notify(url, batch_id, **data):
+    form = {"type": "batch_operation_completed", "data[id]": batch_id, **{f"data[{k}]": v for k, v in data.items()}}
+    return requests.post(url, data=form, timeout=5)
+
+def test_receiver_requires_token(receiver):
+    assert notify(receiver.url, "b1").status_code == 403
+    assert notify(receiver.url + "?token=wrong", "b1").status_code == 403
+    assert receiver.pop_completed(["b1"]) == set()
+    assert notify(engine.webhook_url(receiver.url, "s3cret"), "b1").status_code == 200
+    assert receiver.pop_completed(["b1", "b2"]) == {"b1"}
+
+def test_receiver_needs_a_token():
+    with pytest.raises(ValueError):
+        engine.BatchWebhookReceiver(None)
+
+def test_forged_notification_does_not_finish_a_batch(mailchimp, receiver):
+    mailchimp.batch_seconds = 60
+    client = engine.get_mailchimp_client()
+    batch_id = engine._start_batch(client, "test", [
+        engine._member_operation("list", 0, {"email_address": "a@b.com", "status": "subscribed"}, True)
+    ], lambda level, message: None)
+    done = []
+    tracker = engine.BatchTracker(client, on_done=lambda key, status: done.append(status),
+                                  report=lambda level, message: None, webhook=receiver)
+    tracker.add(batch_id, 0, "test")
+    threading.Thread(target=tracker.run, daemon=True).start()
+    notify(engine.webhook_url(receiver.url, "s3cret"), batch_id, status="finished", errored_operations="0",
+           response_body_url="http://attacker.example/results.tar.gz")
+    time.sleep(1.5)
+    assert done == []
+    tracker._outstanding.clear()
+    tracker.close()
+
+def test_ensure_batch_webhook_replaces_untokenized_registration():
+    class Webhooks:
+        def __init__(self):
+            self.hooks = [{"id": "old", "url": "https://example.org/hook"}]
+        def list(self):
+            return {"webhooks": list(self.hooks)}
+        def remove(self, webhook_id):
+            self.hooks = [hook for hook in self.hooks if hook["id"] != webhook_id]
+        def create(self, body):
+            self.hooks.append({"id": "new", **body})
+
+    client = type("Client", (), {"batchWebhooks": Webhooks()})()
+    engine.ensure_batch_webhook(client, "https://example.org/hook", "s3cret")
+    assert client.batchWebhooks.hooks == [{"id": "new", "url": "https://example.org/hook?token=s3cret"}]
+
+def test_notification_before_wait_is_not_lost(receiver):
+    url = engine.webhook_url(receiver.url, "s3cret")
+    notify(url, "b1")
+    start = time.monotonic()
+    assert receiver.wait(["b1", "b2"], 10)
+    assert time.monotonic() - start < 1
+    assert not receiver.wait(["b2"], 0.2)
+
+def test_untracked_notifications_are_pruned(receiver, monkeypatch):
+    monkeypatch.setattr(engine, "MAILCHIMP_BATCH_WEBHOOK_RETENTION", 0)
+    url = engine.webhook_url(receiver.url, "s3cret")
+    notify(url, "other-account-batch")
+    notify(url, "b1")
+    assert set(receiver._completed) == {"b1"}
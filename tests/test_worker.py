@@ -0,0 +1,39 @@
+import logging
+
+import engine
+import worker
+
+def test_stale_running_job_is_requeued(workdir):
+    job_queue = worker.JobQueue()
+    queue_id = job_queue.submit("contacts.csv", "contacts.csv", upsert=True)
+    assert job_queue.claim("host:1:1")["queue_id"] == queue_id
+    assert job_queue.claim("host:2:1") is None
+
+    # El worker que lo reclamó deja de dar señales de vida
+    with job_queue._conn:
+        job_queue._conn.execute("UPDATE upload_queue SET heartbeat_at = datetime('now', '-1 hour')")
+    job = job_queue.claim("host:2:1")
+    assert job["queue_id"] == queue_id
+    assert job_queue.get(queue_id)["worker"] == "host:2:1"
+    assert any("requeued" in event.get("text", "") for _, event in job_queue.events(queue_id))
+    job_queue.close()
+
+def test_heartbeat_keeps_the_lease(workdir):
+    job_queue = worker.JobQueue()
+    queue_id = job_queue.submit("contacts.csv", "contacts.csv")
+    job_queue.claim("host:1:1")
+    with job_queue._conn:
+        job_queue._conn.execute("UPDATE upload_queue SET heartbeat_at = datetime('now', '-1 hour')")
+    job_queue.heartbeat("host:1:1", [queue_id])
+    assert job_queue.claim("host:2:1") is None
+    assert job_queue.get(queue_id)["worker"] == "host:1:1"
+    job_queue.close()
+
+def test_background_worker_logs_the_metrics_summary(workdir, monkeypatch, capfd):
+    krasdale = logging.getLogger("krasdale")
+    monkeypatch.setattr(krasdale, "handlers", [])
+    monkeypatch.setattr(krasdale, "level", logging.NOTSET)
+    monkeypatch.setattr(logging.getLogger(), "handlers", [])
+    worker.configure_logging()
+    engine.RunMetrics().report(lambda event: None)
+    assert '"summary"' in capfd.readouterr().err
@@ -0,0 +1,244 @@
+"""
+Cola local de trabajos de carga y worker que los procesa en segundo plano.
+La app de Streamlit y `cli.py submit` encolan archivos; `cli.py worker` (o el
+worker que arranca la propia app) los sube con engine.upload_file y guarda su
+progreso como eventos, que la interfaz consulta para mostrar el estado.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from engine import JOB_JOURNAL_PATH, MAILCHIMP_MAX_WORKERS, SQLITE_TIMEOUT, UPLOAD_CHUNK_SIZE, RunMetrics, secret, upload_file
+
+logger = logging.getLogger("krasdale")
+
+# Carpeta donde se guardan los archivos encolados
+JOB_INBOX_DIR = secret("job_inbox_dir", "uploads")
+# Archivos que un worker procesa a la vez
+WORKER_CONCURRENCY = int(secret("worker_concurrency", 1))
+# Un trabajo 'running' cuyo worker no da señales de vida en este tiempo (el
+# proceso murió o se reinició) vuelve a la cola y lo reanuda otro worker
+JOB_LEASE_SECONDS = int(secret("job_lease_seconds", 120))
+
+class JobQueue:
+    """
+    Cola de trabajos en SQLite (en el mismo archivo que el JobJournal), segura
+    para varios procesos: cada trabajo lo reclama un único worker, que lo
+    mantiene con heartbeat() mientras lo procesa.
+    """
+
+    def __init__(self, path=JOB_JOURNAL_PATH):
+        self._conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS upload_queue (
+                    queue_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    file_path TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    options TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    results TEXT,
+                    error TEXT,
+                    submitted_at TEXT NOT NULL,
+                    started_at TEXT,
+                    finished_at TEXT,
+                    heartbeat_at TEXT
+                )
+            """)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(upload_queue)")}
+            if "heartbeat_at" not in columns:
+                self._conn.execute("ALTER TABLE upload_queue ADD COLUMN heartbeat_at TEXT")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS upload_queue_events (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    queue_id INTEGER NOT NULL,
+                    event TEXT NOT NULL
+                )
+            """)
+
+    def submit(self, file_path, file_name, **options):
+        """Encola un archivo; options se pasan a engine.upload_file. Devuelve el queue_id."""
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "INSERT INTO upload_queue (file_path, file_name, options, status, submitted_at) "
+                "VALUES (?, ?, ?, 'queued', datetime('now'))",
+                (file_path, file_name, json.dumps(options))
+            ).lastrowid
+
+    def claim(self, worker):
+        """Reclama el trabajo en cola más antiguo. Devuelve un diccionario o None."""
+        self.requeue_stale()
+        with self._lock:
+            while True:
+                row = self._conn.execute(
+                    "SELECT queue_id, file_path, file_name, options FROM upload_queue "
+                    "WHERE status = 'queued' ORDER BY queue_id LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None
+                with self._conn:
+                    claimed = self._conn.execute(
+                        "UPDATE upload_queue SET status = 'running', worker = ?, started_at = datetime('now'), "
+                        "heartbeat_at = datetime('now') WHERE queue_id = ? AND status = 'queued'",
+                        (worker, row[0])
+                    ).rowcount
+                # Si otro worker se adelantó, probar con el siguiente
+                if claimed:
+                    queue_id, file_path, file_name, options = row
+                    return {"queue_id": queue_id, "file_path": file_path, "file_name": file_name,
+                            "options": json.loads(options)}
+
+    def heartbeat(self, worker, queue_ids):
+        """Renueva la concesión de los trabajos que worker está procesando."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE upload_queue SET heartbeat_at = datetime('now') "
+                "WHERE queue_id = ? AND worker = ? AND status = 'running'",
+                [(queue_id, worker) for queue_id in queue_ids]
+            )
+
+    def requeue_stale(self, lease_seconds=JOB_LEASE_SECONDS):
+        """
+        Devuelve a la cola los trabajos 'running' sin heartbeat en lease_seconds
+        segundos; al procesarlos de nuevo, el JobJournal reanuda la carga.
+        """
+        with self._lock:
+            with self._conn:
+                stale = self._conn.execute(
+                    "SELECT queue_id, worker FROM upload_queue WHERE status = 'running' "
+                    "AND (heartbeat_at IS NULL OR heartbeat_at < datetime('now', ?))",
+                    (f"-{lease_seconds} seconds",)
+                ).fetchall()
+                for queue_id, worker in stale:
+                    # Solo si sigue igual: otro proceso puede haberlo reencolado ya
+                    requeued = self._conn.execute(
+                        "UPDATE upload_queue SET status = 'queued', worker = NULL, heartbeat_at = NULL "
+                        "WHERE queue_id = ? AND status = 'running' AND worker IS ?",
+                        (queue_id, worker)
+                    ).rowcount
+                    if requeued:
+                        logger.warning("Requeued job %s: worker %s stopped responding", queue_id, worker)
+                        self._conn.execute(
+                            "INSERT INTO upload_queue_events (queue_id, event) VALUES (?, ?)",
+                            (queue_id, json.dumps({"type": "message", "level": "warning",
+                                                   "text": f"Worker {worker} stopped responding; the upload was requeued "
+                                                           f"and will resume where it left off."}))
+                        )
+
+    def add_event(self, queue_id, event):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO upload_queue_events (queue_id, event) VALUES (?, ?)",
+                (queue_id, json.dumps(event, default=str))
+            )
+
+    def events(self, queue_id, after=0):
+        """Eventos de un trabajo posteriores a la secuencia after: [(seq, evento)]."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, event FROM upload_queue_events WHERE queue_id = ? AND seq > ? ORDER BY seq",
+                (queue_id, after)
+            ).fetchall()
+        return [(seq, json.loads(event)) for seq, event in rows]
+
+    def finish(self, queue_id, status, results=None, error=None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE upload_queue SET status = ?, results = ?, error = ?, finished_at = datetime('now') "
+                "WHERE queue_id = ?",
+                (status, json.dumps(results) if results is not None else None, error, queue_id)
+            )
+
+    def get(self, queue_id):
+        """Estado de un trabajo como diccionario, o None si no existe."""
+        jobs = self._select("WHERE queue_id = ?", (queue_id,))
+        return jobs[0] if jobs else None
+
+    def recent(self, limit=10):
+        """Últimos trabajos encolados, del más reciente al más antiguo."""
+        return self._select("ORDER BY queue_id DESC LIMIT ?", (limit,))
+
+    def _select(self, clause, params):
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT queue_id, file_name, status, worker, results, error, submitted_at, started_at, finished_at "
+                f"FROM upload_queue {clause}",
+                params
+            )
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        jobs = [dict(zip(columns, row)) for row in rows]
+        for job in jobs:
+            job["results"] = json.loads(job["results"]) if job["results"] else None
+        return jobs
+
+    def close(self):
+        self._conn.close()
+
+def _process(job_queue, job):
+    """Ejecuta un trabajo reclamado y guarda su progreso y resultado en la cola."""
+    queue_id = job["queue_id"]
+    options = {"upsert": True, "chunk_size": UPLOAD_CHUNK_SIZE, "max_workers": MAILCHIMP_MAX_WORKERS, **job["options"]}
+    logger.info("Processing job %s (%s)", queue_id, job["file_name"])
+    try:
+        results = upload_file(job["file_path"], on_event=lambda event: job_queue.add_event(queue_id, event),
+                              metrics=RunMetrics(run_id=f"job-{queue_id}"), **options)
+    except Exception as e:
+        logger.exception("Job %s failed", queue_id)
+        job_queue.add_event(queue_id, {"type": "message", "level": "error", "text": f"Upload failed: {str(e)}"})
+        job_queue.finish(queue_id, "failed", error=str(e))
+    else:
+        job_queue.finish(queue_id, "done", results=results)
+
+def run_worker(concurrency=WORKER_CONCURRENCY, poll_interval=2.0, stop_event=None):
+    """
+    Procesa la cola hasta que se active stop_event, con hasta concurrency
+    archivos a la vez. Cada archivo usa su propio pool de MAILCHIMP_MAX_WORKERS
+    hilos: concurrency * MAILCHIMP_MAX_WORKERS no debería pasar de 10, el límite
+    de conexiones simultáneas de Mailchimp.
+    """
+    job_queue = JobQueue()
+    name = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    running = {}  # future -> queue_id
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while not (stop_event and stop_event.is_set()):
+            running = {future: queue_id for future, queue_id in running.items() if not future.done()}
+            try:
+                # Cada vuelta del bucle (como mucho poll_interval segundos) renueva las concesiones
+                job_queue.heartbeat(name, running.values())
+                job = job_queue.claim(name) if len(running) < concurrency else None
+            except Exception:
+                # Un error de la cola (p. ej. la base bloqueada) no puede parar el bucle:
+                # los trabajos en curso siguen y sin heartbeat otro worker los repetiría
+                logger.exception("Worker %s: error accessing the job queue", name)
+                job = None
+            if job:
+                running[pool.submit(_process, job_queue, job)] = job["queue_id"]
+            else:
+                time.sleep(poll_interval)
+
+def configure_logging(level=logging.INFO):
+    """
+    Muestra los logs de krasdale (incluido el resumen de krasdale.metrics) en
+    stderr cuando nadie ha configurado logging, como dentro de Streamlit.
+    """
+    if logger.level == logging.NOTSET:
+        logger.setLevel(level)
+    if not logger.handlers and not logging.getLogger().handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+        logger.addHandler(handler)
+
+def start_background_worker(concurrency=WORKER_CONCURRENCY):
+    """Arranca run_worker en un hilo daemon. Devuelve el Event que lo detiene."""
+    configure_logging()
+    stop_event = threading.Event()
+    threading.Thread(target=run_worker, args=(concurrency,), kwargs={"stop_event": stop_event}, daemon=True).start()
+    return stop_event